@@ -1,66 +1,77 @@
-import re
+import argparse
+import bisect
+import hashlib
+import json
+import mmap
+import os
+import pickle
+import struct
 import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 
 A_INSTRUCTION: str = "A_INSTRUCTION"
 C_INSTRUCTION: str = "C_INSTRUCTION"
 L_INSTRUCTION: str = "L_INSTRUCTION"
 
+# ソースを一度だけ走査し、コメント・空白を除いた命令を順に返す
+# 各要素は (命令タイプ, 本体, 行番号)。A/L命令の本体はシンボル、C命令は命令文字列
+def iter_instructions(lines):
+    for lineno, line in enumerate(lines, 1):
+        if '//' in line:
+            line = line[:line.index('//')]
+        line = line.strip()
+        if not line:
+            continue
+        if line[0] == '@':
+            yield (A_INSTRUCTION, line[1:].strip(), lineno)
+        elif line[0] == '(' and line[-1] == ')':
+            yield (L_INSTRUCTION, line[1:-1].strip(), lineno)
+        else:
+            yield (C_INSTRUCTION, line, lineno)
+
+# 命令リストを作る
+def load_instructions(lines):
+    return list(iter_instructions(lines))
+
 class Parser:
 
-    # 入力ファイル/データストリームを開き解析の準備をする
+    # 入力ファイルを一度だけ読み込み、命令リストを作成する
     def __init__(self, file_path: str):
         self.file_path = file_path
-        self.fp = open(file_path, "r")
-        self.binary = ['0'] * 16
+        with open(file_path, "r") as fp:
+            self.instructions = load_instructions(fp)
+        self.index = -1
         self.current_line = ""
-        self.instruction_type = None        
+        self.instruction_type = None
 
-    # 入力にまだ行があるのか
+    # 入力にまだ命令があるのか
     def hasMoreLines(self) -> bool:
-        cur_line = self.fp.tell()
-        line = self.fp.readline()
-        self.fp.seek(cur_line)
-        return line != ''
+        return self.index + 1 < len(self.instructions)
 
-    # 空白、コメントをスキップ
+    # 次の命令を現在の命令にする
     def advance(self):
-        while True:
-            line = self.fp.readline()
-            stripped = line.strip()
-            if stripped == '' or stripped.startswith('//'):
-                continue
-            self.current_line = stripped
-            self.instruction_type = None
-            return stripped
+        self.index += 1
+        instr_type, body, _ = self.instructions[self.index]
+        self.instruction_type = instr_type
+        if instr_type == A_INSTRUCTION:
+            self.current_line = '@' + body
+        elif instr_type == L_INSTRUCTION:
+            self.current_line = '(' + body + ')'
+        else:
+            self.current_line = body
+        return self.current_line
 
     # 命令のタイプを示す
     def instructionType(self):
-        if self.instruction_type:
-            return self.instruction_type
-        
-        line = self.current_line
-        if line.startswith('@'):
-            self.instruction_type = A_INSTRUCTION
-            return A_INSTRUCTION
-        elif re.fullmatch(r'\(.+\)', line):
-            self.instruction_type = L_INSTRUCTION
-            return L_INSTRUCTION
-        else:
-            self.instruction_type = C_INSTRUCTION
-            return C_INSTRUCTION
+        return self.instruction_type
 
     # 命令が(〇〇)の場合シンボル〇〇を返す
     def symbol(self):
-        line = self.current_line
-        instr_type = self.instructionType()
-        if instr_type == L_INSTRUCTION:
-            m = re.search(r'\((.+)\)', line)
-            return m.group(1)
-        elif instr_type == A_INSTRUCTION:
-            m = re.search(r'@(.+)', line)
-            return m.group(1)
-        return None
+        if self.instruction_type == C_INSTRUCTION:
+            return None
+        return self.instructions[self.index][1]
 
     # 現在のC命令のdest部分を返す
     def dest(self):
@@ -84,12 +95,74 @@ class Parser:
         if ';' in line:
             return line.split(';')[1].strip()
         return None
+
     def close(self):
-        self.fp.close()
+        pass
+
+# compニーモニックとビット列の対応表
+COMP_TABLE = {
+    # a=0 の場合
+    "0":   "0101010",
+    "1":   "0111111", 
+    "-1":  "0111010",
+    "D":   "0001100",
+    "A":   "0110000",
+    "!D":  "0001101",
+    "!A":  "0110001", 
+    "-D":  "0001111",
+    "-A":  "0110011",
+    "D+1": "0011111",
+    "A+1": "0110111",
+    "D-1": "0001110",
+    "A-1": "0110010", 
+    "D+A": "0000010",
+    "D-A": "0010011",
+    "A-D": "0000111",
+    "D&A": "0000000",
+    "D|A": "0010101",
+    # a=1 の場合 (AをMに置換)
+    "M":   "1110000",
+    "!M":  "1110001",
+    "-M":  "1110011", 
+    "M+1": "1110111",
+    "M-1": "1110010",
+    "D+M": "1000010",
+    "D-M": "1010011",
+    "M-D": "1000111", 
+    "D&M": "1000000",
+    "D|M": "1010101"
+}
+
+# jumpニーモニックとビット列の対応表
+JUMP_TABLE = {
+    None:  "000",
+    "JGT": "001",
+    "JEQ": "010", 
+    "JGE": "011",
+    "JLT": "100",
+    "JNE": "101",
+    "JLE": "110",
+    "JMP": "111"
+}
+
+# C命令の固定プレフィックス 111
+C_PREFIX = 0b111 << 13
+
+# パック形式(.hackb)のヘッダ: マジック, バージョン, 予約, 語数 (リトルエンディアン)
+PACKED_MAGIC = b"HACK"
+PACKED_VERSION = 1
+PACKED_HEADER = struct.Struct("<4sHHI")
+
+# インクリメンタル再アセンブル用キャッシュの形式バージョン
+CACHE_VERSION = 1
+
+# 再配置可能オブジェクト(.hobj)の形式バージョン
+OBJECT_VERSION = 1
 
 class Code:
     def __init__(self):
-        pass
+        # 正規化したC命令文字列 -> 16ビットの機械語
+        self.c_cache = {}
 
     # destニーモニックのバイナリコード
     def dest(self, dest):
@@ -105,53 +178,36 @@ class Code:
     
     # compニーモニックのバイナリコード
     def comp(self, comp: str):
-        comp_table = {
-            # a=0 の場合
-            "0":   "0101010",
-            "1":   "0111111", 
-            "-1":  "0111010",
-            "D":   "0001100",
-            "A":   "0110000",
-            "!D":  "0001101",
-            "!A":  "0110001", 
-            "-D":  "0001111",
-            "-A":  "0110011",
-            "D+1": "0011111",
-            "A+1": "0110111",
-            "D-1": "0001110",
-            "A-1": "0110010", 
-            "D+A": "0000010",
-            "D-A": "0010011",
-            "A-D": "0000111",
-            "D&A": "0000000",
-            "D|A": "0010101",
-            # a=1 の場合 (AをMに置換)
-            "M":   "1110000",
-            "!M":  "1110001",
-            "-M":  "1110011", 
-            "M+1": "1110111",
-            "M-1": "1110010",
-            "D+M": "1000010",
-            "D-M": "1010011",
-            "M-D": "1000111", 
-            "D&M": "1000000",
-            "D|M": "1010101"
-        }
-        return comp_table.get(comp, "0000000")
+        return COMP_TABLE.get(comp, "0000000")
 
     # jumpニーモニックのバイナリコード
     def jump(self, jump: str):
-        jump_table = {
-            None:  "000",
-            "JGT": "001",
-            "JEQ": "010", 
-            "JGE": "011",
-            "JLT": "100",
-            "JNE": "101",
-            "JLE": "110",
-            "JMP": "111"
-        }
-        return jump_table.get(jump, "000")
+        return JUMP_TABLE.get(jump, "000")
+
+    # C命令全体を16ビットの整数に変換する
+    # 同じ命令文字列は一度だけ分解し、以降はキャッシュから返す
+    def encodeC(self, instruction: str) -> int:
+        word = self.c_cache.get(instruction)
+        if word is not None:
+            return word
+
+        # 空白を除いた形で正規化し、表記ゆれも同じエントリにまとめる
+        normalized = ''.join(instruction.split())
+        word = self.c_cache.get(normalized)
+        if word is None:
+            rest = normalized
+            dest = None
+            jump = None
+            if '=' in rest:
+                dest, rest = rest.split('=', 1)
+            if ';' in rest:
+                rest, jump = rest.split(';', 1)
+            bits = self.comp(rest) + self.dest(dest) + self.jump(jump)
+            word = C_PREFIX | int(bits, 2)
+            self.c_cache[normalized] = word
+
+        self.c_cache[instruction] = word
+        return word
     
 class SymbolTable:
     # 新しい空のシンボルテーブルを作成
@@ -173,41 +229,24 @@ class SymbolTable:
     def getAddress(self, symbol):
         return self.table.get(symbol)
 
-def assemble_file(input_file, output_file):
-    parser = Parser(input_file)
-    code = Code()
-    symbol_table = SymbolTable()
-
-    # 第一パス
+# 第一パス: ラベルにROMアドレスを割り当てる
+def first_pass(instructions, symbol_table):
     rom_addr = 0
-    while parser.hasMoreLines():
-        line = parser.advance()
-        if line is None:
-            break
-
-        instr_type = parser.instructionType()
+    for instr_type, body, _ in instructions:
         if instr_type == L_INSTRUCTION:
-            symbol = parser.symbol()
-            symbol_table.addEntry(symbol, rom_addr)
+            symbol_table.addEntry(body, rom_addr)
         else:
             rom_addr += 1
 
-    parser.close()
-
-    # 第二パス
-    parser = Parser(input_file)
+# 第二パス: 変数にRAMアドレスを割り当て、機械語に変換する
+def second_pass(instructions, symbol_table, code):
     ram_addr = 16
     machine_code = []
-    
-    while parser.hasMoreLines():
-        line = parser.advance()
-        if line is None:
-            break
-
-        instr_type = parser.instructionType()
+    encode_c = code.encodeC
 
+    for instr_type, body, _ in instructions:
         if instr_type == A_INSTRUCTION:
-            symbol = parser.symbol()
+            symbol = body
 
             if symbol.isdigit():
                 addr = int(symbol)
@@ -219,43 +258,714 @@ def assemble_file(input_file, output_file):
                     addr = ram_addr
                     ram_addr += 1
 
-            binary = format(addr, '016b')
-            machine_code.append(binary)
-        
+            machine_code.append(addr)
+
         elif instr_type == C_INSTRUCTION:
-            dest_str = parser.dest()
-            comp_str = parser.comp()
-            jump_str = parser.jump()
+            machine_code.append(encode_c(body))
+
+    return machine_code
+
+# C命令を (dest, comp, jump) に分解する
+def _split_c(instruction):
+    rest = ''.join(instruction.split())
+    dest = ''
+    jump = ''
+    if '=' in rest:
+        dest, rest = rest.split('=', 1)
+    if ';' in rest:
+        rest, jump = rest.split(';', 1)
+    return dest, rest, jump
+
+# ラベル解決前の命令リストに対するのぞき穴最適化
+# ラベル(ジャンプ先)をまたぐ書き換えは行わない。次の規則を変化がなくなるまで適用する
+#   redundant_load: Aレジスタが既に同じ値を持つ @X、直後の@で上書きされる @X を削除
+#   stack_bump:     同じアドレスへの M=M+1 と M=M-1 の連続を両方削除
+#   dead_store:     次の命令で読まれずに上書きされる D/M への書き込みを削除
+def optimize(instructions):
+    stats = {"redundant_load": 0, "stack_bump": 0, "dead_store": 0}
+    changed = True
+    while changed:
+        changed = False
+        result = []
+        known_a = None
+        for record in instructions:
+            instr_type, body, _ = record
+            if instr_type == L_INSTRUCTION:
+                known_a = None
+                result.append(record)
+                continue
 
-            dest_bits = code.dest(dest_str)
-            comp_bits = code.comp(comp_str)
-            jump_bits = code.jump(jump_str)
+            if instr_type == A_INSTRUCTION:
+                if body == known_a:
+                    stats["redundant_load"] += 1
+                    changed = True
+                    continue
+                # 直前の @ は読まれずに上書きされる
+                if result and result[-1][0] == A_INSTRUCTION:
+                    result.pop()
+                    stats["redundant_load"] += 1
+                    changed = True
+                known_a = body
+                result.append(record)
+                continue
 
-            binary = "111" + comp_bits + dest_bits + jump_bits
-            machine_code.append(binary)
+            dest, comp, jump = _split_c(body)
+            prev = result[-1] if result else None
+            if prev is not None and prev[0] == C_INSTRUCTION:
+                prev_dest, prev_comp, prev_jump = _split_c(prev[1])
+
+                # M=M+1 と M=M-1 は打ち消し合う
+                if (not jump and not prev_jump and dest == 'M' and prev_dest == 'M'
+                        and {comp, prev_comp} == {'M+1', 'M-1'}):
+                    result.pop()
+                    stats["stack_bump"] += 2
+                    changed = True
+                    continue
+
+                # 直前の M への書き込みが読まれずに上書きされる
+                if (not prev_jump and prev_dest == 'M' and 'M' in dest
+                        and 'M' not in comp):
+                    result.pop()
+                    stats["dead_store"] += 1
+                    changed = True
+
+            # 直前の D への書き込みが読まれずに上書きされる(間のA命令はDを読まない)
+            if 'D' in dest and 'D' not in comp:
+                i = len(result) - 1
+                while i >= 0 and result[i][0] == A_INSTRUCTION:
+                    i -= 1
+                if i >= 0 and result[i][0] == C_INSTRUCTION:
+                    prev_dest, _, prev_jump = _split_c(result[i][1])
+                    if prev_dest == 'D' and not prev_jump:
+                        del result[i]
+                        stats["dead_store"] += 1
+                        changed = True
+
+            if 'A' in dest:
+                known_a = None
+            result.append(record)
+        instructions = result
+
+    stats["words_saved"] = stats["redundant_load"] + stats["stack_bump"] + stats["dead_store"]
+    return instructions, stats
+
+# 変数のRAMアドレスを出現順に事前確定する(第一パスの後に呼ぶ)
+# これ以降の第二パスはシンボル表を変更しないので、命令ごとに独立して変換できる
+def allocate_variables(instructions, symbol_table):
+    ram_addr = 16
+    for instr_type, body, _ in instructions:
+        if instr_type == A_INSTRUCTION and not body.isdigit():
+            if not symbol_table.contains(body):
+                symbol_table.addEntry(body, ram_addr)
+                ram_addr += 1
+
+# ワーカープロセスごとに保持する確定済みシンボル表と変換器
+_worker_symbol_table = None
+_worker_code = None
+
+def _init_worker(table):
+    global _worker_symbol_table, _worker_code
+    _worker_symbol_table = SymbolTable()
+    _worker_symbol_table.table = table
+    _worker_code = Code()
+
+# '@シンボル' かC命令文字列のリストを確定済みのシンボル表で変換する
+def _encode_bodies(bodies, table, code):
+    encode_c = code.encodeC
+    words = []
+    append = words.append
+    for body in bodies:
+        if body[0] == '@':
+            symbol = body[1:]
+            append(int(symbol) if symbol.isdigit() else table[symbol])
+        else:
+            append(encode_c(body))
+    return words
+
+# ラベルを除いた命令を '@シンボル' かC命令文字列のリストにする
+def _instruction_bodies(instructions):
+    return ['@' + body if instr_type == A_INSTRUCTION else body
+            for instr_type, body, _ in instructions
+            if instr_type != L_INSTRUCTION]
+
+# 結果はプロセス間の転送量を抑えるため整数配列のバイト列で返す
+def _encode_chunk(chunk):
+    words = _encode_bodies(chunk, _worker_symbol_table.table, _worker_code)
+    return array('I', words).tobytes()
+
+# 第二パスをプロセスプールで並列に実行する
+# 変数は事前に確定させるので、出力は逐次版の second_pass と完全に一致する
+def parallel_second_pass(instructions, symbol_table, jobs, chunk_size=None):
+    allocate_variables(instructions, symbol_table)
+
+    # プロセス間の転送量を抑えるため、ラベルを除いた命令文字列だけを送る
+    bodies = _instruction_bodies(instructions)
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(bodies) // (jobs * 4)))
+    chunks = [bodies[i:i + chunk_size] for i in range(0, len(bodies), chunk_size)]
+
+    words = array('I')
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(symbol_table.table,)) as executor:
+        for data in executor.map(_encode_chunk, chunks):
+            words.frombytes(data)
+    return words.tolist()
+
+# 行のイテラブル(またはテキストストリーム)を受け取り、機械語を1語ずつ返す
+# 第一パスでは行テキストを保持せず、C命令は変換済みの整数、A命令は数値か
+# シンボル文字列だけをバッファに積むので、メモリ量は命令数に比例する
+def assemble_lines(lines, code=None, symbol_table=None):
+    if code is None:
+        code = Code()
+    if symbol_table is None:
+        symbol_table = SymbolTable()
+    encode_c = code.encodeC
 
+    # 第一パス
+    buffer = []
+    rom_addr = 0
+    for instr_type, body, _ in iter_instructions(lines):
+        if instr_type == L_INSTRUCTION:
+            symbol_table.addEntry(body, rom_addr)
+            continue
+        if instr_type == A_INSTRUCTION:
+            buffer.append(int(body) if body.isdigit() else sys.intern(body))
+        else:
+            buffer.append(encode_c(body))
+        rom_addr += 1
+
+    # 第二パス
+    ram_addr = 16
+    for item in buffer:
+        if item.__class__ is str:
+            addr = symbol_table.getAddress(item)
+            if addr is None:
+                symbol_table.addEntry(item, ram_addr)
+                addr = ram_addr
+                ram_addr += 1
+            yield addr
+        else:
+            yield item
+
+# 機械語をテキスト形式でストリームに書き込む
+def write_hack_stream(machine_code, fp, chunk_size=4096):
+    chunk = []
+    for word in machine_code:
+        chunk.append(format(word, '016b') + '\n')
+        if len(chunk) >= chunk_size:
+            fp.write(''.join(chunk))
+            chunk = []
+    if chunk:
+        fp.write(''.join(chunk))
+
+# 機械語をテキスト形式(.hack)で書き込む
+def write_hack(machine_code, output_file):
+    with open(output_file, 'w') as f:
+        write_hack_stream(machine_code, f)
+
+# 機械語をパック形式(ヘッダ + uint16配列)で一括書き込みする
+def write_packed(machine_code, output_file):
+    with open(output_file, 'wb') as f:
+        write_packed_stream(machine_code, f)
+
+# 機械語をパック形式でバイナリストリームに書き込む
+def write_packed_stream(machine_code, fp):
+    words = array('H', machine_code)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    header = PACKED_HEADER.pack(PACKED_MAGIC, PACKED_VERSION, 0, len(words))
+    fp.write(header + words.tobytes())
+
+# パック形式のROMをmmapで読み込む
+# as_numpy=True の場合はmmap上のNumPyビューを、それ以外はarray('H')を返す
+def load_packed(file_path, as_numpy=False):
+    with open(file_path, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    if len(mm) < PACKED_HEADER.size:
+        mm.close()
+        raise ValueError(f"{file_path}: パック形式のヘッダがありません")
+    magic, version, _, count = PACKED_HEADER.unpack_from(mm, 0)
+    if magic != PACKED_MAGIC or version != PACKED_VERSION:
+        mm.close()
+        raise ValueError(f"{file_path}: パック形式ではありません")
+    end = PACKED_HEADER.size + count * 2
+    if len(mm) < end:
+        mm.close()
+        raise ValueError(f"{file_path}: データが途中で切れています")
+
+    if as_numpy:
+        import numpy
+        return numpy.frombuffer(mm, dtype='<u2', count=count, offset=PACKED_HEADER.size)
+
+    words = array('H')
+    words.frombytes(mm[PACKED_HEADER.size:end])
+    mm.close()
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words
+
+# シンボルマップ(.sym)を書き込む
+#   L 名前 ROMアドレス   ラベル
+#   V 名前 RAMアドレス   変数
+#   S ROMアドレス 行番号 ROMアドレスとソース行の対応。次のS行までは両方が1ずつ進む
+def write_symbols(instructions, symbol_table, output_file):
+    predefined = SymbolTable().table
+    labels = [body for instr_type, body, _ in instructions if instr_type == L_INSTRUCTION]
+    label_set = set(labels)
+
+    lines = ["# Hack symbol map"]
+    for name in labels:
+        lines.append(f"L {name} {symbol_table.getAddress(name)}")
+    for name, addr in symbol_table.table.items():
+        if name not in predefined and name not in label_set:
+            lines.append(f"V {name} {addr}")
+
+    rom_addr = 0
+    prev_line = None
+    for instr_type, _, lineno in instructions:
+        if instr_type == L_INSTRUCTION:
+            continue
+        if prev_line is None or lineno != prev_line + 1:
+            lines.append(f"S {rom_addr} {lineno}")
+        prev_line = lineno
+        rom_addr += 1
+
+    with open(output_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# リスティング(.lst)を書き込む: ROMアドレス, 機械語, 行番号, 命令
+def write_listing(instructions, machine_code, output_file):
+    lines = []
+    rom_addr = 0
+    for instr_type, body, lineno in instructions:
+        if instr_type == L_INSTRUCTION:
+            lines.append(f"{'':>5}  {'':16}  {lineno:>6}  ({body})")
+            continue
+        text = '@' + body if instr_type == A_INSTRUCTION else body
+        lines.append(f"{rom_addr:>5}  {machine_code[rom_addr]:016b}  {lineno:>6}  {text}")
+        rom_addr += 1
+
+    with open(output_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+# シンボルマップの索引。デバッガやプロファイラがアドレスを名前に戻すのに使う
+class SymbolMap:
+    def __init__(self, labels, variables, runs):
+        self.labels = labels
+        self.variables = variables
+        self.rom_labels = {}
+        for name, addr in labels.items():
+            self.rom_labels.setdefault(addr, name)
+        self.ram_variables = {addr: name for name, addr in variables.items()}
+
+        self._label_addrs = sorted(self.rom_labels)
+        self._run_addrs = [addr for addr, _ in runs]
+        self._run_lines = [lineno for _, lineno in runs]
+
+    # ROMアドレスを含む直前のラベル(関数など)を返す
+    def enclosingLabel(self, rom_addr):
+        i = bisect.bisect_right(self._label_addrs, rom_addr) - 1
+        if i < 0:
+            return None
+        return self.rom_labels[self._label_addrs[i]]
+
+    # ROMアドレスに対応するソースの行番号を返す
+    def sourceLine(self, rom_addr):
+        i = bisect.bisect_right(self._run_addrs, rom_addr) - 1
+        if i < 0:
+            return None
+        return self._run_lines[i] + rom_addr - self._run_addrs[i]
+
+# シンボルマップ(.sym)を読み込む。"名前 アドレス" の2列の行はラベルとして扱う
+def load_symbols(file_path):
+    labels = {}
+    variables = {}
+    runs = []
+    with open(file_path, 'r') as f:
+        for line in f:
+            if '#' in line:
+                line = line[:line.index('#')]
+            parts = line.split()
+            if len(parts) == 2:
+                labels[parts[0]] = int(parts[1])
+            elif len(parts) == 3:
+                kind, first, second = parts
+                if kind == 'L':
+                    labels[first] = int(second)
+                elif kind == 'V':
+                    variables[first] = int(second)
+                elif kind == 'S':
+                    runs.append((int(first), int(second)))
+    runs.sort()
+    return SymbolMap(labels, variables, runs)
+
+def assemble_file(input_file, output_file, packed=False, jobs=1, optimize_code=False,
+                  symbol_file=None, listing_file=None):
+    # ソースは一度だけ読み込み、両パスで同じ命令リストを使う
+    parser = Parser(input_file)
+    instructions = parser.instructions
     parser.close()
 
+    stats = None
+    if optimize_code:
+        instructions, stats = optimize(instructions)
+
+    code = Code()
+    symbol_table = SymbolTable()
+
+    first_pass(instructions, symbol_table)
+    if jobs > 1:
+        machine_code = parallel_second_pass(instructions, symbol_table, jobs)
+    else:
+        machine_code = second_pass(instructions, symbol_table, code)
+
+    if packed:
+        write_packed(machine_code, output_file)
+    else:
+        write_hack(machine_code, output_file)
+
+    if symbol_file:
+        write_symbols(instructions, symbol_table, symbol_file)
+    if listing_file:
+        write_listing(instructions, machine_code, listing_file)
+    return stats
+
+# 命令リストを再配置可能なオブジェクトにアセンブルする
+# ユニット内で定義したラベルはすべて公開し、ユニット先頭からのオフセットで持つ
+#   relocs:  ローカルラベルを参照する語の位置(リンク時にベースアドレスを加える)
+#   externs: 未定義シンボル -> 参照する語の位置。出現順を保つ
+# 未定義シンボルは、リンク時に他ユニットのラベルなら解決し、それ以外は変数として
+# リンク順・出現順にRAMを割り当てる。結果は全ユニットを連結してアセンブルした場合と一致する
+def assemble_object(instructions):
+    predefined = SymbolTable().table
+    labels = {}
+    rom_addr = 0
+    for instr_type, body, _ in instructions:
+        if instr_type == L_INSTRUCTION:
+            labels[body] = rom_addr
+        else:
+            rom_addr += 1
+
+    code = Code()
+    words = []
+    relocs = []
+    externs = {}
+    for instr_type, body, _ in instructions:
+        if instr_type == C_INSTRUCTION:
+            words.append(code.encodeC(body))
+        elif instr_type == A_INSTRUCTION:
+            if body.isdigit():
+                words.append(int(body))
+            elif body in labels:
+                relocs.append(len(words))
+                words.append(labels[body])
+            elif body in predefined:
+                words.append(predefined[body])
+            else:
+                externs.setdefault(body, []).append(len(words))
+                words.append(0)
+
+    return {"version": OBJECT_VERSION, "labels": labels, "words": words,
+            "relocs": relocs, "externs": externs}
+
+def write_object(obj, output_file):
     with open(output_file, 'w') as f:
-        for code_line in machine_code:
-            f.write(code_line + '\n')
+        json.dump(obj, f, separators=(',', ':'))
+
+def load_object(file_path):
+    with open(file_path, 'r') as f:
+        obj = json.load(f)
+    if obj.get("version") != OBJECT_VERSION:
+        raise ValueError(f"{file_path}: 対応していないオブジェクト形式です")
+    return obj
+
+# オブジェクトを順に連結して1つのROMにする
+# 機械語, ラベル表, 変数表 を返す
+def link_objects(objects):
+    words = []
+    bases = []
+    labels = {}
+    for obj in objects:
+        base = len(words)
+        bases.append(base)
+        for name, offset in obj["labels"].items():
+            if name in labels:
+                raise ValueError(f"ラベル {name} が複数のユニットで定義されています")
+            labels[name] = base + offset
+        words.extend(obj["words"])
+        if base:
+            for pos in obj["relocs"]:
+                words[base + pos] += base
+
+    variables = {}
+    ram_addr = 16
+    for obj, base in zip(objects, bases):
+        for symbol, positions in obj["externs"].items():
+            addr = labels.get(symbol)
+            if addr is None:
+                addr = variables.get(symbol)
+                if addr is None:
+                    addr = variables[symbol] = ram_addr
+                    ram_addr += 1
+            for pos in positions:
+                words[base + pos] = addr
+
+    return words, labels, variables
+
+# 入力ファイルごとのキャッシュファイルのパス
+def _cache_file(cache_dir, input_file):
+    key = hashlib.sha1(os.path.abspath(input_file).encode()).hexdigest()
+    return os.path.join(cache_dir, key + ".pickle")
+
+# キャッシュファイルは (ヘッダ, 状態) の2つのpickleを続けて保存する
+# ヘッダだけなら先頭の小さなオブジェクトを読むだけで済む
+def _load_cache(cache_file, with_state=False):
+    try:
+        with open(cache_file, 'rb') as f:
+            header = pickle.load(f)
+            if header[0] != CACHE_VERSION:
+                return None, None
+            state = pickle.load(f) if with_state else None
+        return header, state
+    except (OSError, EOFError, pickle.UnpicklingError, IndexError, TypeError):
+        return None, None
+
+def _save_cache(cache_file, header, state):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(header, f, pickle.HIGHEST_PROTOCOL)
+        pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
+
+# 命令数が変わらない場合、変化した語だけを出力ファイル上で書き換える
+def _patch_output(output_file, packed, changed, words, width):
+    with open(output_file, 'r+b') as f:
+        for i in changed:
+            if packed:
+                f.seek(PACKED_HEADER.size + i * 2)
+                f.write(struct.pack('<H', words[i]))
+            else:
+                f.seek(i * width)
+                f.write(format(words[i], '016b').encode())
+
+# ソースのハッシュをキーにしたキャッシュを使って再アセンブルする
+# 変更がなければハッシュ計算だけで終わり、小さな編集では変化した範囲の命令と
+# アドレスが移動したシンボルを参照する命令だけを変換し直す
+def assemble_file_incremental(input_file, output_file, cache_dir, packed=False):
+    with open(input_file, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    cache_file = _cache_file(cache_dir, input_file)
+    target = (os.path.abspath(output_file), packed)
+
+    old_header, _ = _load_cache(cache_file)
+    if (old_header is not None and old_header[1] == digest
+            and old_header[2] == target and os.path.exists(output_file)
+            and os.path.getsize(output_file) == old_header[3]):
+        return {"status": "unchanged", "encoded": 0, "written": 0}
+
+    instructions = load_instructions(data.decode().splitlines())
+    symbol_table = SymbolTable()
+    first_pass(instructions, symbol_table)
+    allocate_variables(instructions, symbol_table)
+    table = symbol_table.table
+    bodies = _instruction_bodies(instructions)
+    code = Code()
+
+    state = None
+    if (old_header is not None and old_header[2] == target
+            and os.path.exists(output_file)
+            and os.path.getsize(output_file) == old_header[3]):
+        _, state = _load_cache(cache_file, with_state=True)
+
+    if state is None:
+        words = _encode_bodies(bodies, table, code)
+        encoded = len(words)
+        changed = None
+    else:
+        old_bodies, old_table, old_words = state
+        n_old = len(old_bodies)
+        n_new = len(bodies)
+
+        # 先頭と末尾の一致する範囲は前回の語を再利用する
+        limit = min(n_old, n_new)
+        prefix = 0
+        while prefix < limit and old_bodies[prefix] == bodies[prefix]:
+            prefix += 1
+        suffix = 0
+        while (suffix < limit - prefix
+               and old_bodies[n_old - 1 - suffix] == bodies[n_new - 1 - suffix]):
+            suffix += 1
+
+        # アドレスが変わったシンボル(移動したラベル、割り当て直された変数)
+        moved = {symbol for symbol, addr in table.items()
+                 if old_table.get(symbol) != addr}
+
+        words = [0] * n_new
+        encoded = 0
+        reused = list(range(prefix)) + list(range(n_new - suffix, n_new))
+        for i in reused:
+            body = bodies[i]
+            if body[0] == '@' and body[1:] in moved:
+                words[i] = table[body[1:]]
+                encoded += 1
+            else:
+                words[i] = old_words[i if i < prefix else i - n_new + n_old]
+        middle = _encode_bodies(bodies[prefix:n_new - suffix], table, code)
+        words[prefix:n_new - suffix] = middle
+        encoded += len(middle)
+
+        changed = None
+        if n_new == n_old:
+            changed = [i for i in range(n_new) if words[i] != old_words[i]]
+
+    if changed is None:
+        if packed:
+            write_packed(words, output_file)
+        else:
+            write_hack(words, output_file)
+        written = len(words)
+        status = "full" if state is None else "incremental"
+    else:
+        width = old_header[3] // len(words) if words else 0
+        _patch_output(output_file, packed, changed, words, width)
+        written = len(changed)
+        status = "incremental"
+
+    header = (CACHE_VERSION, digest, target, os.path.getsize(output_file))
+    _save_cache(cache_file, header, (bodies, table, words))
+    return {"status": status, "encoded": encoded, "written": written}
 
 if __name__ == "__main__":
     
-    args = sys.argv
-    if len(args) != 2:
-        print("Argument is invalid")
-    
-    input_file = args[1]
-    output_file = input_file.replace('.asm', '.hack')
+    arg_parser = argparse.ArgumentParser(description="Hackアセンブラ")
+    arg_parser.add_argument("input_file", nargs="?",
+                            help="入力する.asmファイル ('-' で標準入力)")
+    arg_parser.add_argument("-o", "--output",
+                            help="出力ファイル ('-' で標準出力)")
+    arg_parser.add_argument("--packed", action="store_true",
+                            help="ヘッダ + uint16配列のパック形式(.hackb)で出力する")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="第二パスの並列プロセス数 (0でCPU数)")
+    arg_parser.add_argument("--cache-dir", nargs="?", const=".hackcache",
+                            help="インクリメンタル再アセンブルのキャッシュ先 (省略時 .hackcache)")
+    arg_parser.add_argument("-O", "--optimize", action="store_true",
+                            help="のぞき穴最適化を行う (通常モードのみ)")
+    arg_parser.add_argument("--tst",
+                            help="-O の前後のROMを.tstのRAMの初期値で停止するまで実行し、"
+                                 "削減したサイクル数を報告する (通常モードのみ)")
+    arg_parser.add_argument("--max-cycles", type=int, default=10 ** 7,
+                            help="--tst で実行する命令数の上限")
+    arg_parser.add_argument("--symbols", action="store_true",
+                            help="シンボルマップ(.sym)を出力する (通常モードのみ)")
+    arg_parser.add_argument("--listing", action="store_true",
+                            help="リスティング(.lst)を出力する (通常モードのみ)")
+    arg_parser.add_argument("-c", "--object", action="store_true",
+                            help="再配置可能なオブジェクト(.hobj)を出力する")
+    arg_parser.add_argument("--link", nargs="+", metavar="OBJ",
+                            help="オブジェクトをリンクしてROMを出力する")
+    args = arg_parser.parse_args()
+
+    # リンクモード: .hobjを連結して.hack/.hackbを出力する
+    if args.link:
+        output_file = args.output or os.path.splitext(args.link[0])[0] + (
+            '.hackb' if args.packed else '.hack')
+        try:
+            words, _, _ = link_objects([load_object(path) for path in args.link])
+            if args.packed:
+                write_packed(words, output_file)
+            else:
+                write_hack(words, output_file)
+            print("リンク終了")
+        except Exception as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.input_file is None:
+        arg_parser.error("入力ファイルを指定してください")
+    input_file = args.input_file
+
+    # オブジェクトモード: .asmを1ユニットとして.hobjに変換する
+    if args.object:
+        output_file = args.output or os.path.splitext(input_file)[0] + '.hobj'
+        try:
+            instructions = Parser(input_file).instructions
+            if args.optimize:
+                instructions, _ = optimize(instructions)
+            write_object(assemble_object(instructions), output_file)
+            print("アセンブル終了")
+        except Exception as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+        sys.exit(0)
+
+    if args.output:
+        output_file = args.output
+    elif input_file == '-':
+        output_file = '-'
+    elif args.packed:
+        output_file = input_file.replace('.asm', '.hackb')
+    else:
+        output_file = input_file.replace('.asm', '.hack')
+
+    # パイプラインモード: 標準入力から読み、標準出力へ書く
+    if input_file == '-' or output_file == '-':
+        try:
+            if input_file == '-':
+                words = assemble_lines(sys.stdin)
+            else:
+                with open(input_file, 'r') as f:
+                    words = list(assemble_lines(f))
+
+            if output_file == '-':
+                if args.packed:
+                    write_packed_stream(words, sys.stdout.buffer)
+                else:
+                    write_hack_stream(words, sys.stdout)
+                sys.stdout.flush()
+            elif args.packed:
+                write_packed(words, output_file)
+            else:
+                write_hack(words, output_file)
+        except Exception as e:
+            print(f"エラー: {e}", file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
     
     try:
-        assemble_file(input_file, output_file)
+        if args.cache_dir:
+            stats = assemble_file_incremental(input_file, output_file,
+                                              args.cache_dir, packed=args.packed)
+            print(f"{stats['status']}: 変換 {stats['encoded']} 語, 書き込み {stats['written']} 語")
+        else:
+            jobs = args.jobs if args.jobs > 0 else os.cpu_count() or 1
+            base = os.path.splitext(output_file)[0]
+            stats = assemble_file(input_file, output_file, packed=args.packed, jobs=jobs,
+                                  optimize_code=args.optimize,
+                                  symbol_file=base + ".sym" if args.symbols else None,
+                                  listing_file=base + ".lst" if args.listing else None)
+            if stats is not None:
+                print(f"最適化: ROM {stats['words_saved']} 語削減 "
+                      f"(A命令 {stats['redundant_load']}, スタック操作 {stats['stack_bump']}, "
+                      f"デッドストア {stats['dead_store']})")
+            if stats is not None and args.tst:
+                # エミュレータはこのモジュールを読み込むので、計測するときだけ読み込む
+                import emulator
+                with open(input_file, 'r') as f:
+                    before = list(assemble_lines(f))
+                presets = emulator.load_presets(args.tst)
+                try:
+                    before_cycles = emulator.count_cycles(before, presets, args.max_cycles)
+                    after_cycles = emulator.count_cycles(
+                        emulator.load_rom(output_file).tolist(), presets, args.max_cycles)
+                    print(f"実行: {before_cycles} -> {after_cycles} 命令 "
+                          f"({before_cycles - after_cycles} サイクル削減)")
+                except ValueError as e:
+                    print(f"サイクル数を計測できません: {e}")
         print("アセンブル終了")
     except Exception as e:
         print(f"エラー: {e}")
         sys.exit(1)
-
-
-
-
@@ -0,0 +1,243 @@
+import argparse
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import assembler
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CORPUS = ["Add", "Max", "MaxL", "Rect", "RectL", "Pong", "PongL"]
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "benchmark_baseline.json")
+
+
+C_MNEMONICS = ["D=M", "M=D", "A=M", "D=A", "M=M+1", "M=M-1", "AM=M-1", "D=D+M",
+               "M=D+M", "D=M-D", "MD=M+1", "D;JGT", "D;JEQ", "0;JMP", "D;JNE", "A=A-1"]
+
+# ベンチマーク用の合成プログラムを生成する
+# label_density: ラベル宣言の割合, variable_density: 変数を参照するA命令の割合
+def generate_program(n_lines, label_density=0.02, variable_density=0.1,
+                     n_variables=500, seed=0):
+    rng = random.Random(seed)
+    n_labels = max(1, int(n_lines * label_density))
+    label_lines = set(rng.sample(range(n_lines), min(n_labels, n_lines)))
+
+    lines = []
+    label_id = 0
+    for i in range(n_lines):
+        if i in label_lines:
+            lines.append(f"(L{label_id})")
+            label_id += 1
+        elif rng.random() < 0.5:
+            r = rng.random()
+            if r < variable_density:
+                lines.append(f"@var{rng.randrange(n_variables)}")
+            elif r < variable_density + 0.2:
+                lines.append(f"@L{rng.randrange(len(label_lines))}")
+            else:
+                lines.append(f"@{rng.randrange(32768)}")
+        else:
+            lines.append(rng.choice(C_MNEMONICS))
+    return lines
+
+# 並列数ごとのスループットを計測する
+def run_scaling(n_lines, jobs_list, seed=0):
+    lines = generate_program(n_lines, seed=seed)
+    instructions = assembler.load_instructions(lines)
+
+    symbol_table = assembler.SymbolTable()
+    assembler.first_pass(instructions, symbol_table)
+    expected = assembler.second_pass(instructions, symbol_table, assembler.Code())
+
+    print(f"{n_lines} lines, cpu_count={os.cpu_count()}")
+    print(f"{'jobs':>4} {'pass2 [s]':>10} {'lines/s':>12} {'speedup':>8}")
+    base = None
+    for jobs in jobs_list:
+        symbol_table = assembler.SymbolTable()
+        assembler.first_pass(instructions, symbol_table)
+
+        start = time.perf_counter()
+        if jobs > 1:
+            machine_code = assembler.parallel_second_pass(instructions, symbol_table, jobs)
+        else:
+            machine_code = assembler.second_pass(instructions, symbol_table, assembler.Code())
+        elapsed = time.perf_counter() - start
+
+        if machine_code != expected:
+            print(f"jobs={jobs}: 逐次版と出力が一致しません", file=sys.stderr)
+            sys.exit(1)
+        if base is None:
+            base = elapsed
+        print(f"{jobs:>4} {elapsed:>10.3f} {n_lines / elapsed:>12.0f} {base / elapsed:>8.2f}")
+
+# プロセスの最大RSS(MB)
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linuxはキロバイト、macOSはバイト単位
+    if sys.platform == "darwin":
+        return rss / (1024 * 1024)
+    return rss / 1024
+
+# 1ケースを計測する。最大RSSをケースごとに測るため新しいプロセスで実行される
+def measure_file(input_file, repeat):
+    best = None
+    output_file = os.path.join(tempfile.gettempdir(), f"bench_{os.getpid()}.hack")
+    try:
+        for _ in range(repeat):
+            phases = {}
+            start = time.perf_counter()
+            with open(input_file, "r") as f:
+                instructions = assembler.load_instructions(f)
+            phases["scan"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            symbol_table = assembler.SymbolTable()
+            assembler.first_pass(instructions, symbol_table)
+            phases["pass1"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            machine_code = assembler.second_pass(instructions, symbol_table, assembler.Code())
+            phases["pass2"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            assembler.write_hack(machine_code, output_file)
+            phases["write"] = time.perf_counter() - start
+
+            phases["total"] = sum(phases.values())
+            if best is None or phases["total"] < best["total"]:
+                best = phases
+    finally:
+        if os.path.exists(output_file):
+            os.remove(output_file)
+
+    with open(input_file, "r") as f:
+        n_lines = sum(1 for _ in f)
+    return {
+        "lines": n_lines,
+        "words": len(machine_code),
+        "phases": best,
+        "lines_per_sec": n_lines / best["total"],
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+def _measure_isolated(input_file, repeat):
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        return executor.submit(measure_file, input_file, repeat).result()
+
+# 実コーパスと合成プログラムでベンチマークを実行する
+def run_suite(sizes, label_density, variable_density, repeat, seed=0):
+    results = {}
+    for name in CORPUS:
+        path = os.path.join(BENCH_DIR, name + ".asm")
+        if os.path.exists(path):
+            results[name] = _measure_isolated(path, repeat)
+            print_result(name, results[name])
+
+    for n_lines in sizes:
+        name = f"gen{n_lines}_l{label_density}_v{variable_density}"
+        lines = generate_program(n_lines, label_density, variable_density, seed=seed)
+        fd, path = tempfile.mkstemp(suffix=".asm")
+        try:
+            with os.fdopen(fd, "w") as f:
+                f.write("\n".join(lines) + "\n")
+            del lines
+            results[name] = _measure_isolated(path, repeat)
+        finally:
+            os.remove(path)
+        print_result(name, results[name])
+    return results
+
+def print_header():
+    print(f"{'case':<28} {'lines':>9} {'lines/s':>11} {'scan':>8} {'pass1':>8} "
+          f"{'pass2':>8} {'write':>8} {'RSS[MB]':>8}")
+
+def print_result(name, result):
+    phases = result["phases"]
+    rss = result["peak_rss_mb"]
+    rss = f"{rss:>8.1f}" if rss is not None else f"{'-':>8}"
+    print(f"{name:<28} {result['lines']:>9} {result['lines_per_sec']:>11.0f} "
+          f"{phases['scan']:>8.4f} {phases['pass1']:>8.4f} {phases['pass2']:>8.4f} "
+          f"{phases['write']:>8.4f} {rss}")
+
+# ベースラインと比較し、スループットが許容範囲を超えて落ちたケースを返す
+def compare_baseline(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        ratio = result["lines_per_sec"] / base["lines_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append((name, ratio))
+    return regressions
+
+# 1ケースをcProfileで計測し、上位の関数を表示する
+def run_profile(input_file, limit):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    assembler.assemble_file(input_file, os.devnull)
+    profiler.disable()
+    pstats.Stats(profiler).sort_stats("cumulative").print_stats(limit)
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Hackアセンブラのベンチマーク")
+    sub = arg_parser.add_subparsers(dest="command", required=True)
+
+    scaling = sub.add_parser("scaling", help="並列第二パスのスケーリングを計測する")
+    scaling.add_argument("--lines", type=int, default=1_000_000)
+    scaling.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8])
+    scaling.add_argument("--seed", type=int, default=0)
+
+    suite = sub.add_parser("suite", help="コーパスと合成プログラムで各フェーズを計測する")
+    suite.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000],
+                       help="合成プログラムの行数 (例: 100000 1000000 10000000)")
+    suite.add_argument("--label-density", type=float, default=0.02)
+    suite.add_argument("--variable-density", type=float, default=0.1)
+    suite.add_argument("--repeat", type=int, default=3)
+    suite.add_argument("--seed", type=int, default=0)
+    suite.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE,
+                       help="結果をベースラインとして保存する")
+    suite.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE,
+                       help="ベースラインと比較し、劣化があれば終了コード1を返す")
+    suite.add_argument("--tolerance", type=float, default=0.2,
+                       help="許容するスループット低下の割合")
+
+    profile = sub.add_parser("profile", help="cProfileで1ファイルのアセンブルを計測する")
+    profile.add_argument("input_file", nargs="?", default=os.path.join(BENCH_DIR, "Pong.asm"))
+    profile.add_argument("--limit", type=int, default=20)
+
+    args = arg_parser.parse_args()
+    if args.command == "scaling":
+        run_scaling(args.lines, args.jobs, args.seed)
+    elif args.command == "profile":
+        run_profile(args.input_file, args.limit)
+    elif args.command == "suite":
+        print_header()
+        results = run_suite(args.sizes, args.label_density, args.variable_density,
+                            args.repeat, args.seed)
+        if args.save_baseline:
+            with open(args.save_baseline, "w") as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+            print(f"ベースラインを保存: {args.save_baseline}")
+        if args.compare:
+            with open(args.compare, "r") as f:
+                baseline = json.load(f)
+            regressions = compare_baseline(results, baseline, args.tolerance)
+            for name, ratio in regressions:
+                print(f"劣化: {name} スループット {ratio:.2f} 倍")
+            if regressions:
+                sys.exit(1)
+            print("ベースラインからの劣化なし")
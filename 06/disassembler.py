@@ -0,0 +1,190 @@
+import argparse
+import os
+import sys
+from array import array
+
+from assembler import COMP_TABLE, JUMP_TABLE, PACKED_MAGIC, load_packed, load_symbols
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+DEST_NAMES = ["", "M", "D", "MD", "A", "AM", "AD", "AMD"]
+
+# C命令の下位13ビット(a, comp, dest, jump)から命令文字列への変換表(compが不明な場合はNone)
+def _build_c_names():
+    comp_names = {int(bits, 2): name for name, bits in COMP_TABLE.items()}
+    jump_names = {int(bits, 2): name for name, bits in JUMP_TABLE.items() if name}
+    names = []
+    for low in range(1 << 13):
+        comp = comp_names.get(low >> 6)
+        dest = DEST_NAMES[(low >> 3) & 0b111]
+        jump = jump_names.get(low & 0b111)
+        if comp is None:
+            names.append(None)
+            continue
+        text = comp
+        if dest:
+            text = dest + "=" + text
+        if jump:
+            text = text + ";" + jump
+        names.append(text)
+    return names
+
+# 標準の形でないC命令の語の表記。アドレスがずれないように1語を必ず1命令で表し、コメントで印を付ける
+# compが不明な語は何もしない命令 0 に置き換える
+# 上位3ビットが111でない語は、CPUと同じく下位13ビットで解釈する(再アセンブルすると111の語になる)
+def irregular_text(word: int) -> str:
+    name = C_NAMES[word & 0x1FFF]
+    if name is None:
+        return f"0 // 不明な命令 {word:016b}"
+    return f"{name} // 非標準の命令 {word:016b}"
+
+C_NAMES = _build_c_names()
+# 上位3ビットが111のC命令の表
+C_TABLE = [name if name is not None else irregular_text(0xE000 | low)
+           for low, name in enumerate(C_NAMES)]
+A_TABLE = ["@" + str(value) for value in range(1 << 15)]
+
+if numpy is not None:
+    C_TABLE_NP = numpy.array(C_TABLE, dtype=object)
+    A_TABLE_NP = numpy.array(A_TABLE, dtype=object)
+
+# .hack(テキスト)または.hackb(パック形式)のROMを読み込む
+def load_rom(file_path):
+    with open(file_path, 'rb') as f:
+        magic = f.read(len(PACKED_MAGIC))
+    if magic == PACKED_MAGIC:
+        return load_packed(file_path, as_numpy=numpy is not None)
+
+    with open(file_path, 'r') as f:
+        words = array('H', [int(line, 2) for line in f if line.strip()])
+    if numpy is not None:
+        return numpy.frombuffer(words, dtype=numpy.uint16)
+    return words
+
+# シンボルマップ(.sym)を読み込み、(ROMアドレス->ラベル, RAMアドレス->変数) を返す
+def load_symbol_map(file_path):
+    symbols = load_symbols(file_path)
+    return symbols.rom_labels, symbols.ram_variables
+
+# 直後にジャンプするA命令の値はROMアドレスとみなし、ジャンプ先の集合を返す
+def find_jump_targets(words):
+    n = len(words)
+    if numpy is not None and isinstance(words, numpy.ndarray):
+        is_a = words[:-1] < 0x8000
+        is_jump = (words[1:] >= 0x8000) & ((words[1:] & 0b111) != 0)
+        values = words[:-1][is_a & is_jump]
+        return set(int(v) for v in numpy.unique(values[values < n]))
+
+    targets = set()
+    for i in range(n - 1):
+        value = words[i]
+        nxt = words[i + 1]
+        if value < 0x8000 and nxt & 0x8000 and nxt & 0b111 and value < n:
+            targets.add(value)
+    return targets
+
+# シンボルに置き換えるA命令の (アドレス, 名前) のリストを返す
+# 直後がジャンプならラベル、直後がMを読み書きするなら変数とみなす
+# アドレスは15ビット以内なので、C命令の語がキーに一致することはない
+def find_symbol_refs(words, labels, variables):
+    if numpy is not None and isinstance(words, numpy.ndarray):
+        nxt = numpy.append(words[1:], 0)
+        is_c = nxt >= 0x8000
+        is_jump = is_c & ((nxt & 0b111) != 0)
+        touches_m = is_c & ~is_jump & (((nxt & 0x1000) != 0) | ((nxt & 0b1000) != 0))
+        refs = []
+        for symbols, mask in ((labels, is_jump), (variables, touches_m)):
+            if not symbols:
+                continue
+            keys = numpy.fromiter(symbols.keys(), dtype=numpy.int64, count=len(symbols))
+            hits = numpy.nonzero(mask & numpy.isin(words, keys))[0]
+            refs.extend((i, symbols[value])
+                        for i, value in zip(hits.tolist(), words[hits].tolist()))
+        return refs
+
+    refs = []
+    values = words.tolist()
+    values.append(0)
+    for i, value in enumerate(values[:-1]):
+        if value not in labels and value not in variables:
+            continue
+        nxt = values[i + 1]
+        if not nxt & 0x8000:
+            continue
+        if nxt & 0b111:
+            name = labels.get(value)
+        elif nxt & 0x1000 or nxt & 0b1000:
+            name = variables.get(value)
+        else:
+            name = None
+        if name is not None:
+            refs.append((i, name))
+    return refs
+
+# ROM全体を表引きでアセンブリに戻す
+def decode(words):
+    if numpy is not None and isinstance(words, numpy.ndarray):
+        words = words.astype(numpy.uint16, copy=False)
+        is_c = words >= 0x8000
+        texts = numpy.where(is_c, C_TABLE_NP[words & 0x1FFF], A_TABLE_NP[words & 0x7FFF])
+        texts = texts.tolist()
+        for i in numpy.nonzero(is_c & (words < 0xE000))[0].tolist():
+            texts[i] = irregular_text(int(words[i]))
+        return texts
+    return [A_TABLE[w] if w < 0x8000 else C_TABLE[w & 0x1FFF] if w >= 0xE000
+            else irregular_text(w) for w in words]
+
+# 機械語を読みやすいアセンブリ行のリストに変換する
+# labels/variables が無い場合はジャンプ先に L<アドレス> のラベルを自動で付ける
+def disassemble(words, labels=None, variables=None):
+    texts = decode(words)
+    if labels is None:
+        labels = {addr: f"L{addr}" for addr in find_jump_targets(words)}
+    if variables is None:
+        variables = {}
+
+    if labels or variables:
+        for i, name in find_symbol_refs(words, labels, variables):
+            texts[i] = "@" + name
+
+    if not labels:
+        return texts
+    lines = []
+    for addr, text in enumerate(texts):
+        name = labels.get(addr)
+        if name is not None:
+            lines.append(f"({name})")
+        lines.append(text)
+    # プログラムの末尾(最後の語の次)を指すラベルも書き出す。書かないと再アセンブル時に変数として割り当てられる
+    for addr in sorted(addr for addr in labels if addr >= len(texts)):
+        lines.append(f"({labels[addr]})")
+    return lines
+
+def disassemble_file(input_file, output_file, symbol_file=None):
+    words = load_rom(input_file)
+    labels = variables = None
+    if symbol_file:
+        labels, variables = load_symbol_map(symbol_file)
+    lines = disassemble(words, labels, variables)
+    with open(output_file, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Hack逆アセンブラ")
+    arg_parser.add_argument("input_file", help="入力する.hack/.hackbファイル")
+    arg_parser.add_argument("-o", "--output", help="出力する.asmファイル")
+    arg_parser.add_argument("-s", "--symbols", help="ラベルを復元するシンボルファイル")
+    args = arg_parser.parse_args()
+
+    input_file = args.input_file
+    output_file = args.output or os.path.splitext(input_file)[0] + ".dis.asm"
+    try:
+        disassemble_file(input_file, output_file, args.symbols)
+        print("逆アセンブル終了")
+    except Exception as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
@@ -0,0 +1,178 @@
+import argparse
+import os
+import re
+import sys
+
+from assembler import COMP_TABLE
+from disassembler import load_rom
+
+
+RAM_SIZE = 32768
+
+# comp(ニーモニック)ごとのALUの計算。引数は (D, A, M) で、結果は呼び出し側で16ビットに丸める
+COMP_FUNCTIONS = {
+    "0": lambda d, a, m: 0,
+    "1": lambda d, a, m: 1,
+    "-1": lambda d, a, m: -1,
+    "D": lambda d, a, m: d,
+    "A": lambda d, a, m: a,
+    "!D": lambda d, a, m: ~d,
+    "!A": lambda d, a, m: ~a,
+    "-D": lambda d, a, m: -d,
+    "-A": lambda d, a, m: -a,
+    "D+1": lambda d, a, m: d + 1,
+    "A+1": lambda d, a, m: a + 1,
+    "D-1": lambda d, a, m: d - 1,
+    "A-1": lambda d, a, m: a - 1,
+    "D+A": lambda d, a, m: d + a,
+    "D-A": lambda d, a, m: d - a,
+    "A-D": lambda d, a, m: a - d,
+    "D&A": lambda d, a, m: d & a,
+    "D|A": lambda d, a, m: d | a,
+    "M": lambda d, a, m: m,
+    "!M": lambda d, a, m: ~m,
+    "-M": lambda d, a, m: -m,
+    "M+1": lambda d, a, m: m + 1,
+    "M-1": lambda d, a, m: m - 1,
+    "D+M": lambda d, a, m: d + m,
+    "D-M": lambda d, a, m: d - m,
+    "M-D": lambda d, a, m: m - d,
+    "D&M": lambda d, a, m: d & m,
+    "D|M": lambda d, a, m: d | m,
+}
+# compのビット列(a c1..c6)から計算への表
+COMP_BY_BITS = {int(bits, 2): COMP_FUNCTIONS[name] for name, bits in COMP_TABLE.items()}
+
+# ROMの1語を (comp, dest, jump) にデコードする
+# A命令は compがNone、destが値。C命令はCPUと同じく上位3ビットのうち最上位だけを見る
+def decode_word(address: int, word: int):
+    if word < 0x8000:
+        return (None, word, 0)
+    comp = COMP_BY_BITS.get((word >> 6) & 0x7F)
+    if comp is None:
+        raise ValueError(f"ROM[{address}]: 不明な命令 {word:016b}")
+    return (comp, (word >> 3) & 0b111, word & 0b111)
+
+
+class HackCPU:
+    # ROMを事前デコードしてHackコンピュータを命令単位で実行する
+    # D, A, RAMの値は符号付き16ビットで持つ
+    def __init__(self, words):
+        self.program = [decode_word(address, word) for address, word in enumerate(words)]
+        self.ram = [0] * RAM_SIZE
+        self.a = 0
+        self.d = 0
+        self.pc = 0
+
+    # 停止ループ (@L; 0;JMP でLがその@命令自身) に達するか、ROMの終わりに達するか、
+    # max_cycles命令を実行するまで実行し、(状態, 実行した命令数) を返す
+    # ジャンプ先とMのアドレスは、その命令を実行する前のAの値で決まる
+    def run(self, max_cycles: int = 10 ** 7):
+        program = self.program
+        ram = self.ram
+        a = self.a
+        d = self.d
+        pc = self.pc
+        n = len(program)
+        cycles = 0
+        status = "timeout"
+        for cycles in range(max_cycles):
+            if pc >= n:
+                status = "end"
+                break
+            comp, dest, jump = program[pc]
+            if comp is None:
+                a = dest
+                pc += 1
+                continue
+            address = a & 0x7FFF
+            out = ((comp(d, a, ram[address]) + 32768) & 0xFFFF) - 32768
+            if dest & 0b001:
+                ram[address] = out
+            if dest & 0b010:
+                d = out
+            if dest & 0b100:
+                a = out
+            if jump and ((jump & 0b100 and out < 0) or (jump & 0b010 and out == 0)
+                         or (jump & 0b001 and out > 0)):
+                if jump == 0b111 and address == pc - 1:
+                    status = "halt"
+                    break
+                pc = address
+            else:
+                pc += 1
+        else:
+            cycles = max_cycles
+        self.a = a
+        self.d = d
+        self.pc = pc
+        return status, cycles
+
+# .tstファイルの set RAM[n] v から、実行前に設定する (アドレス, 値) のリストを返す
+def load_presets(tst_path: str):
+    with open(tst_path, "r") as f:
+        text = f.read()
+    return [(int(address), int(value))
+            for address, value in re.findall(r"set\s+RAM\[(\d+)\]\s+(-?\d+)", text)]
+
+# .cmpファイルの1行目の RAM[n] の列と2行目の値から {アドレス: 値} を返す
+def load_expected(cmp_path: str):
+    with open(cmp_path, "r") as f:
+        lines = [line for line in f if line.strip()]
+    headers = [h.strip() for h in lines[0].strip().strip('|').split('|')]
+    values = [v.strip() for v in lines[1].strip().strip('|').split('|')]
+    return {int(re.search(r"\d+", h).group()): int(v) for h, v in zip(headers, values)}
+
+# ROMをRAMの初期値 presets から停止するまで実行し、実行した命令数を返す
+def count_cycles(words, presets, max_cycles: int = 10 ** 7):
+    cpu = HackCPU(words)
+    for address, value in presets:
+        cpu.ram[address] = value
+    status, cycles = cpu.run(max_cycles)
+    if status == "timeout":
+        raise ValueError(f"{max_cycles}命令以内に停止しません")
+    return cycles
+
+# ROMを.tstのRAMの初期値で停止するまで実行し、.cmpと比較する
+# .tstのrepeat回数ではなく停止ループまで実行するので、命令数の異なるコード生成どうしでも比較できる
+# (状態, 実行した命令数, 不一致のリスト [(アドレス, 実際の値, 期待値)]) を返す
+def run_test(rom_file: str, tst_path: str, cmp_path: str, max_cycles: int = 10 ** 7):
+    cpu = HackCPU(load_rom(rom_file).tolist())
+    for address, value in load_presets(tst_path):
+        cpu.ram[address] = value
+    status, cycles = cpu.run(max_cycles)
+    mismatches = [(address, cpu.ram[address], value)
+                  for address, value in load_expected(cmp_path).items()
+                  if cpu.ram[address] != value]
+    return status, cycles, mismatches
+
+if __name__ == "__main__":
+    arg_parser = argparse.ArgumentParser(description="Hack CPUエミュレータ")
+    arg_parser.add_argument("rom_file", help="実行する.hack/.hackbファイル")
+    arg_parser.add_argument("--tst", help="RAMの初期値を読む.tstファイル(.cmpは同じ名前のものと比較する)")
+    arg_parser.add_argument("--max-cycles", type=int, default=10 ** 7,
+                            help="実行する命令数の上限")
+    arg_parser.add_argument("--ram", type=int, nargs="+", default=[],
+                            help="終了後に表示するRAMのアドレス")
+    args = arg_parser.parse_args()
+
+    try:
+        if args.tst:
+            cmp_path = os.path.splitext(args.tst)[0] + ".cmp"
+            status, cycles, mismatches = run_test(args.rom_file, args.tst, cmp_path,
+                                                  args.max_cycles)
+            print(f"実行: {status}, {cycles}命令")
+            for address, actual, value in mismatches:
+                print(f"不一致: RAM[{address}] = {actual} (期待値 {value})")
+            if mismatches:
+                sys.exit(1)
+            print(f"{os.path.basename(cmp_path)} と一致")
+        else:
+            cpu = HackCPU(load_rom(args.rom_file).tolist())
+            status, cycles = cpu.run(args.max_cycles)
+            print(f"実行: {status}, {cycles}命令")
+            for address in args.ram:
+                print(f"RAM[{address}] = {cpu.ram[address]}")
+    except (OSError, ValueError) as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
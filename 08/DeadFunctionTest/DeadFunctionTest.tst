@@ -0,0 +1,13 @@
+// Tests DeadFunctionTest.asm in the CPU emulator.
+// This assembly file results from translating the DeadFunctionTest folder.
+
+compare-to DeadFunctionTest.cmp,
+
+set RAM[0] 256,
+
+repeat 2000 {
+	ticktock;
+}
+
+output-list RAM[5]%D1.6.1 RAM[6]%D1.6.1;
+output;
@@ -0,0 +1,13 @@
+// Tests InlineTest.asm in the CPU emulator.
+// This assembly file results from translating the InlineTest folder.
+
+compare-to InlineTest.cmp,
+
+set RAM[0] 256,
+
+repeat 2000 {
+	ticktock;
+}
+
+output-list RAM[3]%D1.6.1 RAM[5]%D1.6.1 RAM[6]%D1.6.1 RAM[7]%D1.6.1 RAM[8]%D1.6.1;
+output;
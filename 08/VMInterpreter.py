@@ -0,0 +1,330 @@
+import argparse
+import os
+import sys
+import time
+from array import array
+
+from VMTranslator import (C_ARITHMETIC, C_CALL, C_FUNCTION, C_GOTO, C_IF, C_LABEL, C_POP,
+                          C_PUSH, C_RETURN, SEGMENTS, Parser)
+
+RAM_SIZE = 32768
+# staticの割り当てを始めるアドレス(アセンブラの変数と同じ)
+STATIC_BASE = 16
+
+# 事前デコードした命令の番号
+# 基底ポインタを持つセグメントのpushは番号がそのまま基底ポインタのアドレス(LCL=1, ARG=2, THIS=3, THAT=4)、
+# popは番号から POP_OFFSET を引いたものが基底ポインタのアドレスになるように並べる
+OP_PUSH_CONSTANT = 0
+OP_PUSH_LOCAL = 1
+OP_PUSH_ARGUMENT = 2
+OP_PUSH_THIS = 3
+OP_PUSH_THAT = 4
+OP_PUSH_DIRECT = 5
+OP_POP_LOCAL = 6
+OP_POP_ARGUMENT = 7
+OP_POP_THIS = 8
+OP_POP_THAT = 9
+OP_POP_DIRECT = 10
+# 算術論理コマンドはARITHMETIC_COMMANDSと同じ並び
+OP_ADD = 11
+OP_SUB = 12
+OP_NEG = 13
+OP_EQ = 14
+OP_GT = 15
+OP_LT = 16
+OP_AND = 17
+OP_OR = 18
+OP_NOT = 19
+OP_GOTO = 20
+OP_IF = 21
+OP_CALL = 22
+OP_FUNCTION = 23
+OP_RETURN = 24
+OP_HALT = 25
+OP_SET_SP = 26
+
+POP_OFFSET = OP_POP_LOCAL - OP_PUSH_LOCAL
+BASE_SEGMENTS = {"local": 0, "argument": 1, "this": 2, "that": 3}
+
+
+class VMInterpreter:
+    # input_pathのディレクトリ(または1つの.vmファイル)を読み込み、整数の命令列にデコードする
+    #   ops[pc]: 命令番号(OP_*)
+    #   args[pc]: push/popのindexまたは直接アドレス、goto/if-goto/callの飛び先、functionのローカル変数の数
+    #   counts[pc]: callの引数の数(それ以外は0)
+    # ラベルは関数ごとの名前として解決し、自分自身へのgoto(終了時の無限ループ)はHALTにする
+    # Sys.initがある場合は変換後のブートストラップと同じく SP=256 にして call Sys.init 0 から始める
+    # Sys.initが無い場合は先頭のコマンドから、実行前のRAM[0]をSPとして始める
+    # 戻り先のコマンド番号はRAMに収まらないことがあるので、RAMとは別のreturn_stackに積む
+    def __init__(self, input_path: str):
+        if os.path.isdir(input_path):
+            self.vm_files = sorted(os.path.join(input_path, f)
+                                   for f in os.listdir(input_path) if f.endswith('.vm'))
+        else:
+            self.vm_files = [input_path]
+        self.ops = []
+        self.args = []
+        self.counts = []
+        self.statics = {}
+        self.ram = array('h', bytes(2 * RAM_SIZE))
+        self.return_stack = []
+        self.entry = 0
+        self.pc = 0
+        self.decode()
+
+    # 命令を1つ追加し、そのアドレスを返す
+    def emit(self, op: int, arg: int = 0, count: int = 0) -> int:
+        self.ops.append(op)
+        self.args.append(arg)
+        self.counts.append(count)
+        return len(self.ops) - 1
+
+    # static変数のアドレス。ファイル順、ファイル内では初めて現れた順に16から割り当てる
+    def staticAddress(self, file_name: str, index: int) -> int:
+        key = (file_name, index)
+        address = self.statics.get(key)
+        if address is None:
+            address = STATIC_BASE + len(self.statics)
+            self.statics[key] = address
+        return address
+
+    def decode(self):
+        labels = {}
+        functions = {}
+        # 飛び先を後で埋める命令: (アドレス, ラベルのキーまたは関数名, エラー表示用のファイル名)
+        label_fixups = []
+        call_fixups = []
+
+        bootstrap = self.emit(OP_SET_SP, 256)
+        self.emit(OP_CALL, 0, 0)
+        self.emit(OP_HALT)
+        for vm_path in self.vm_files:
+            parser = Parser(vm_path)
+            file_name = os.path.splitext(os.path.basename(vm_path))[0]
+            function = None
+            for i in range(len(parser)):
+                cmd_type = parser.opcodes[i]
+                operand = parser.operands[i]
+                value = parser.values[i]
+                name = parser.names[i]
+                if cmd_type == C_ARITHMETIC:
+                    self.emit(OP_ADD + operand)
+                elif cmd_type == C_PUSH or cmd_type == C_POP:
+                    self.decodePushPop(cmd_type, SEGMENTS[operand], value, file_name, vm_path)
+                elif cmd_type == C_LABEL:
+                    labels[(function, name)] = len(self.ops)
+                elif cmd_type == C_GOTO or cmd_type == C_IF:
+                    pc = self.emit(OP_GOTO if cmd_type == C_GOTO else OP_IF)
+                    label_fixups.append((pc, (function, name), vm_path))
+                elif cmd_type == C_FUNCTION:
+                    function = name
+                    functions[name] = self.emit(OP_FUNCTION, value)
+                elif cmd_type == C_CALL:
+                    pc = self.emit(OP_CALL, 0, value)
+                    call_fixups.append((pc, name, vm_path))
+                elif cmd_type == C_RETURN:
+                    self.emit(OP_RETURN)
+        self.emit(OP_HALT)
+
+        for pc, key, vm_path in label_fixups:
+            if key not in labels:
+                raise ValueError(f"{vm_path}: 未定義のラベル {key[1]}")
+            target = labels[key]
+            self.args[pc] = target
+            if target == pc and self.ops[pc] == OP_GOTO:
+                self.ops[pc] = OP_HALT
+        for pc, name, vm_path in call_fixups:
+            if name not in functions:
+                raise ValueError(f"{vm_path}: 未定義の関数 {name}")
+            self.args[pc] = functions[name]
+
+        if "Sys.init" in functions:
+            self.args[bootstrap + 1] = functions["Sys.init"]
+            self.entry = bootstrap
+        else:
+            self.entry = bootstrap + 3
+        self.pc = self.entry
+        self.ram[0] = 256
+
+    def decodePushPop(self, cmd_type: int, segment: str, index: int, file_name: str,
+                      vm_path: str):
+        if segment == "constant":
+            if cmd_type == C_POP:
+                raise ValueError(f"{vm_path}: constantセグメントにはpopできません")
+            self.emit(OP_PUSH_CONSTANT, index)
+            return
+        if segment in BASE_SEGMENTS:
+            op = OP_PUSH_LOCAL + BASE_SEGMENTS[segment]
+            self.emit(op if cmd_type == C_PUSH else op + POP_OFFSET, index)
+            return
+        if segment == "static":
+            address = self.staticAddress(file_name, index)
+        elif segment == "temp":
+            address = 5 + index
+        else:
+            address = 3 + index
+        self.emit(OP_PUSH_DIRECT if cmd_type == C_PUSH else OP_POP_DIRECT, address)
+
+    # HALTに達するかmax_stepsコマンドを実行するまで実行し、(状態, 実行したVMコマンド数) を返す
+    # 呼び出し元の無いreturn(テスト用に途中の関数から実行した場合)もフレームを戻してから終了する
+    # SPはローカル変数に持ち、終了時にRAM[0]へ書き戻す
+    # フレームの戻りアドレスの欄には、戻り先のコマンド番号を16ビットに丸めた値を置く
+    # eq/gt/ltは変換後のコードと同じく、16ビットに丸めた差の符号で判定する
+    def run(self, max_steps: int = 10 ** 8):
+        ops = self.ops
+        args = self.args
+        counts = self.counts
+        ram = self.ram
+        returns = self.return_stack
+        sp = ram[0]
+        pc = self.pc
+        steps = 0
+        status = "timeout"
+        for steps in range(max_steps):
+            op = ops[pc]
+            arg = args[pc]
+            pc += 1
+            if op < OP_POP_LOCAL:
+                if op == OP_PUSH_CONSTANT:
+                    ram[sp] = arg
+                elif op == OP_PUSH_DIRECT:
+                    ram[sp] = ram[arg]
+                else:
+                    ram[sp] = ram[ram[op] + arg]
+                sp += 1
+            elif op < OP_ADD:
+                sp -= 1
+                if op == OP_POP_DIRECT:
+                    ram[arg] = ram[sp]
+                else:
+                    ram[ram[op - POP_OFFSET] + arg] = ram[sp]
+            elif op < OP_GOTO:
+                if op == OP_NEG:
+                    ram[sp - 1] = ((32768 - ram[sp - 1]) & 0xFFFF) - 32768
+                    continue
+                if op == OP_NOT:
+                    ram[sp - 1] = ~ram[sp - 1]
+                    continue
+                sp -= 1
+                x = ram[sp - 1]
+                y = ram[sp]
+                if op == OP_ADD:
+                    ram[sp - 1] = ((x + y + 32768) & 0xFFFF) - 32768
+                elif op == OP_SUB:
+                    ram[sp - 1] = ((x - y + 32768) & 0xFFFF) - 32768
+                elif op == OP_EQ:
+                    ram[sp - 1] = -1 if x == y else 0
+                elif op == OP_GT:
+                    ram[sp - 1] = -1 if ((x - y + 32768) & 0xFFFF) > 32768 else 0
+                elif op == OP_LT:
+                    ram[sp - 1] = -1 if ((x - y + 32768) & 0xFFFF) < 32768 else 0
+                elif op == OP_AND:
+                    ram[sp - 1] = x & y
+                else:
+                    ram[sp - 1] = x | y
+            elif op == OP_IF:
+                sp -= 1
+                if ram[sp]:
+                    pc = arg
+            elif op == OP_GOTO:
+                pc = arg
+            elif op == OP_CALL:
+                returns.append(pc)
+                ram[sp] = ((pc + 32768) & 0xFFFF) - 32768
+                ram[sp + 1] = ram[1]
+                ram[sp + 2] = ram[2]
+                ram[sp + 3] = ram[3]
+                ram[sp + 4] = ram[4]
+                ram[2] = sp - counts[pc - 1]
+                sp += 5
+                ram[1] = sp
+                pc = arg
+            elif op == OP_FUNCTION:
+                for _ in range(arg):
+                    ram[sp] = 0
+                    sp += 1
+            elif op == OP_RETURN:
+                frame = ram[1]
+                arg_base = ram[2]
+                ram[arg_base] = ram[sp - 1]
+                sp = arg_base + 1
+                ram[4] = ram[frame - 1]
+                ram[3] = ram[frame - 2]
+                ram[2] = ram[frame - 3]
+                ram[1] = ram[frame - 4]
+                if not returns:
+                    status = "halt"
+                    break
+                pc = returns.pop()
+            elif op == OP_SET_SP:
+                sp = arg
+            else:
+                pc -= 1
+                status = "halt"
+                break
+        else:
+            steps = max_steps
+        ram[0] = sp
+        self.pc = pc
+        return status, steps
+
+# --set の ADDR=VALUE を (アドレス, 値) にする
+def parse_assignment(text: str):
+    address, _, value = text.partition("=")
+    return int(address), int(value)
+
+if __name__ == '__main__':
+    # .tst/.cmpの読み込みは06のエミュレータと共通
+    sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "06"))
+    from emulator import load_expected, load_presets
+
+    arg_parser = argparse.ArgumentParser(description="VMインタプリタ")
+    arg_parser.add_argument("input_path", help=".vmファイルを含むディレクトリまたは.vmファイル")
+    arg_parser.add_argument("--max-steps", type=int, default=10 ** 8,
+                            help="実行するVMコマンドの上限")
+    arg_parser.add_argument("--ram", type=int, nargs="+", default=[],
+                            help="終了後に表示するRAMのアドレス")
+    arg_parser.add_argument("--set", type=parse_assignment, nargs="+", action="extend", default=[],
+                            metavar="ADDR=VALUE", help="実行前にRAM[ADDR]をVALUEにする(複数指定可)")
+    arg_parser.add_argument("--tst", nargs="?", const="",
+                            help="実行前に.tstファイルの set RAM[n] v を適用する (省略時 <ディレクトリ名>.tst)")
+    arg_parser.add_argument("--compare", nargs="?", const="",
+                            help="終了後のRAMを.cmpファイルと比較する (省略時 <ディレクトリ名>.cmp)")
+    args = arg_parser.parse_args()
+
+    dir_name = os.path.basename(os.path.normpath(args.input_path))
+    try:
+        start = time.perf_counter()
+        interpreter = VMInterpreter(args.input_path)
+        load_time = time.perf_counter() - start
+        presets = []
+        if args.tst is not None:
+            presets = load_presets(args.tst or os.path.join(args.input_path, f"{dir_name}.tst"))
+        for address, value in presets + args.set:
+            interpreter.ram[address] = value
+        start = time.perf_counter()
+        status, steps = interpreter.run(args.max_steps)
+        run_time = time.perf_counter() - start
+    except (OSError, ValueError, IndexError, OverflowError) as e:
+        print(f"エラー: {e}")
+        sys.exit(1)
+
+    print(f"読み込み: {len(interpreter.vm_files)}ファイル, {len(interpreter.ops)}命令, "
+          f"{load_time:.4f}秒")
+    print(f"実行: {status}, {steps}コマンド, {run_time:.4f}秒 "
+          f"({steps / run_time if run_time else 0:.0f}コマンド/秒)")
+    for address in args.ram:
+        print(f"RAM[{address}] = {interpreter.ram[address]}")
+
+    if args.compare is not None:
+        cmp_path = args.compare
+        if not cmp_path:
+            cmp_path = os.path.join(args.input_path, f"{dir_name}.cmp")
+        expected = load_expected(cmp_path)
+        mismatches = [(address, interpreter.ram[address], value)
+                      for address, value in expected.items() if interpreter.ram[address] != value]
+        for address, actual, value in mismatches:
+            print(f"不一致: RAM[{address}] = {actual} (期待値 {value})")
+        if mismatches:
+            sys.exit(1)
+        print(f"{os.path.basename(cmp_path)} と一致")
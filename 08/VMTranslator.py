@@ -1,5 +1,12 @@
+import argparse
+import hashlib
+import importlib.util
 import os
+import pickle
+import string
 import sys
+from array import array
+from concurrent.futures import ProcessPoolExecutor
 
 C_ARITHMETIC = 0
 C_PUSH = 1
@@ -11,629 +18,1855 @@ C_FUNCTION = 6
 C_RETURN = 7
 C_CALL = 8
 
+# 共有call/returnルーチンのラベル
+CALL_ROUTINE = "VM$CALL"
+RETURN_ROUTINE = "VM$RETURN"
+
+# 基底ポインタを持つセグメント
+SEGMENT_BASES = {
+    "local": "LCL",
+    "argument": "ARG",
+    "this": "THIS",
+    "that": "THAT"
+}
+
+# 機械語まで直接出力する場合に使う06のアセンブラ
+ASSEMBLER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "06",
+                              "assembler.py")
+
+# 変換キャッシュの形式のバージョン(コード生成を変えたら上げる)
+CACHE_VERSION = 6
+
+# ブートストラップコードのラベルに使う名前(Jackのクラス名やファイル名にならない名前にする)
+BOOTSTRAP_SCOPE = "VM$BOOT"
+
+# 共有比較ルーチンのラベルと、条件が真になるジャンプ命令
+COMPARE_ROUTINES = {
+    "eq": ("VM$EQ", "JEQ"),
+    "gt": ("VM$GT", "JGT"),
+    "lt": ("VM$LT", "JLT"),
+}
+# 比較の結果が偽のときに分岐するジャンプ (比較; not; if-goto の融合用)
+NEGATED_JUMPS = {"JEQ": "JNE", "JGT": "JLE", "JLT": "JGE"}
+
+
+# コマンド名とコマンド種別の対応
+COMMAND_TYPES = {
+    "push": C_PUSH,
+    "pop": C_POP,
+    "label": C_LABEL,
+    "goto": C_GOTO,
+    "if-goto": C_IF,
+    "function": C_FUNCTION,
+    "return": C_RETURN,
+    "call": C_CALL,
+}
+
+# 算術論理コマンドとセグメントの名前(IRではこの並びの番号で持つ)
+ARITHMETIC_COMMANDS = ("add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not")
+SEGMENTS = ("constant", "local", "argument", "this", "that", "static", "temp", "pointer")
+ARITHMETIC_IDS = {name: i for i, name in enumerate(ARITHMETIC_COMMANDS)}
+SEGMENT_IDS = {name: i for i, name in enumerate(SEGMENTS)}
 
-class Parser:
 
+class Parser:
+    # ファイル全体を一度だけ読み、コマンドを並列配列のIRに変換する
+    #   opcodes[i]: コマンド種別(C_*)
+    #   operands[i]: 算術論理コマンドまたはセグメントの番号(それ以外は-1)
+    #   values[i]: push/pop/function/callの整数引数(それ以外は0)
+    #   names[i]: label/goto/if-goto/function/callの名前(intern済み、それ以外はNone)
     def __init__(self, file_path: str):
         self.file_path = file_path
-        self.fp = open(file_path, "r")
-        self.cur_line = ""
+        self.opcodes = array('B')
+        self.operands = array('b')
+        self.values = array('i')
+        self.names = []
+        with open(file_path, "r") as f:
+            self.load(f.read())
+
+        # 従来の1コマンドずつ読むインターフェース用
+        self.index = -1
         self.cmd_type = None
-        
+
+    def load(self, text: str):
+        opcodes = self.opcodes
+        operands = self.operands
+        values = self.values
+        names = self.names
+        intern = sys.intern
+        for lineno, line in enumerate(text.splitlines(), 1):
+            parts = line.split('//', 1)[0].split()
+            if not parts:
+                continue
+            cmd = parts[0]
+            arith = ARITHMETIC_IDS.get(cmd)
+            if arith is not None:
+                opcodes.append(C_ARITHMETIC)
+                operands.append(arith)
+                values.append(0)
+                names.append(None)
+                continue
+
+            try:
+                cmd_type = COMMAND_TYPES[cmd]
+                if cmd_type == C_PUSH or cmd_type == C_POP:
+                    operand, value, name = SEGMENT_IDS[parts[1]], int(parts[2]), None
+                elif cmd_type == C_FUNCTION or cmd_type == C_CALL:
+                    operand, value, name = -1, int(parts[2]), intern(parts[1])
+                elif cmd_type == C_RETURN:
+                    operand, value, name = -1, 0, None
+                else:
+                    operand, value, name = -1, 0, intern(parts[1])
+            except (KeyError, IndexError, ValueError):
+                raise ValueError(f"{self.file_path}:{lineno}: 不正なコマンド {line.strip()}")
+            opcodes.append(cmd_type)
+            operands.append(operand)
+            values.append(value)
+            names.append(name)
+
+    def __len__(self):
+        return len(self.opcodes)
+
+    # i番目のコマンドを (コマンド種別, 第一引数, 第二引数) として返す
+    def command(self, i: int):
+        cmd_type = self.opcodes[i]
+        if cmd_type == C_ARITHMETIC:
+            return (cmd_type, ARITHMETIC_COMMANDS[self.operands[i]], None)
+        elif cmd_type == C_PUSH or cmd_type == C_POP:
+            return (cmd_type, SEGMENTS[self.operands[i]], self.values[i])
+        elif cmd_type == C_FUNCTION or cmd_type == C_CALL:
+            return (cmd_type, self.names[i], self.values[i])
+        return (cmd_type, self.names[i], None)
+
+    # すべてのコマンドを (コマンド種別, 第一引数, 第二引数) のリストで返す
+    def commands(self):
+        return [self.command(i) for i in range(len(self.opcodes))]
+
     def close(self):
-        self.fp.close()
+        pass
 
-    # 入力にさらに行があるか
+    # 入力にさらにコマンドがあるか
     def hasMoreLines(self) -> bool:
-        cur_line = self.fp.tell()
-        line = self.fp.readline()
-        self.fp.seek(cur_line)
-        return line != ''
+        return self.index + 1 < len(self.opcodes)
     
-    # 次の入力をよみ現在のコマンドにする
+    # 次のコマンドを現在のコマンドにする
     def advance(self):
-        self.cur_line = self.fp.readline()
+        self.index += 1
 
     # 現在のコマンドの種類の定数を返す
     def commandType(self):
-        line = self.cur_line.strip()
-        if not line or line.startswith('//'):
-            return None
-        
-        if '//' in line:
-            line = line[:line.index('//')]
-        
-        line = line.strip()
-        if not line:
-            return None
-        
-        parts = line.split()
-        if not parts:
-            return None
-
-        cmd = parts[0]
-
-        if cmd in ["add", "sub", "neg", "eq", "gt", "lt", "and", "or", "not"]:
-            self.cmd_type = C_ARITHMETIC
-        elif cmd == "push":
-            self.cmd_type = C_PUSH
-        elif cmd == "pop":
-            self.cmd_type = C_POP
-        elif cmd == "label":
-            self.cmd_type = C_LABEL
-        elif cmd == "if-goto":
-            self.cmd_type = C_IF
-        elif cmd == "goto":
-            self.cmd_type = C_GOTO
-        elif cmd == "function":
-            self.cmd_type = C_FUNCTION
-        elif cmd == "return":
-            self.cmd_type = C_RETURN
-        elif cmd == "call":
-            self.cmd_type = C_CALL
-        
+        self.cmd_type = self.opcodes[self.index]
         return self.cmd_type
     
     # 現在のコマンドの第一引数を返す
     def arg1(self) -> str:
-        line = self.cur_line.strip()
-        if '//' in line:
-            line = line[:line.index('//')]
-        
-        line = line.strip()
-        parts = line.split()
-
-        if self.cmd_type != C_ARITHMETIC:
-            return parts[1]
-        else:
-            return parts[0]
+        return self.command(self.index)[1]
     
     # 現在のコマンドの第二引数を返す
     def arg2(self) -> str:
-        line = self.cur_line.strip()
+        arg2 = self.command(self.index)[2]
+        return None if arg2 is None else str(arg2)
 
-        if '//' in line:
-            line = line[:line.index('//')]
+# アセンブラに直接渡す命令レコードのタイプ(06/assembler.pyと同じ値)
+A_INSTRUCTION = "A_INSTRUCTION"
+C_INSTRUCTION = "C_INSTRUCTION"
+L_INSTRUCTION = "L_INSTRUCTION"
 
-        line = line.strip()
-        parts = line.split()
+# アセンブリの1行を命令レコード (タイプ, 本体, 行番号) にする
+# 生成したコードには元の行が無いので行番号は0とする
+def asm_record(line: str):
+    if line[0] == '@':
+        return (A_INSTRUCTION, line[1:], 0)
+    if line[0] == '(':
+        return (L_INSTRUCTION, line[1:-1], 0)
+    return (C_INSTRUCTION, line, 0)
 
-        if self.cmd_type in [C_PUSH, C_POP, C_FUNCTION, C_CALL]:
-            return parts[2]
+# 命令レコードのリストをアセンブリのテキストに戻す
+def records_text(records) -> str:
+    lines = []
+    for instr_type, body, _ in records:
+        if instr_type == A_INSTRUCTION:
+            lines.append("@" + body + "\n")
+        elif instr_type == L_INSTRUCTION:
+            lines.append("(" + body + ")\n")
         else:
-            return None
+            lines.append(body + "\n")
+    return "".join(lines)
+
+# テンプレートをインデントと空行のない1行1命令の形に整え、(テキスト, 命令レコードのリスト) を返す
+# {}で埋める部分があるテンプレートは、どちらもキーワード引数で値を埋めてコードを返す関数にする
+# テキストは文字列のformatメソッド、命令レコードは{}を含む行だけをformatで埋める
+def compile_template(text: str):
+    lines = [line.strip() for line in text.splitlines() if line.strip()]
+    code = "".join(line + "\n" for line in lines)
+    records = [asm_record(line) for line in lines]
+    if not any(name for _, name, _, _ in string.Formatter().parse(code)):
+        return code, records
+    parts = [(record, "{" in record[1]) for record in records]
+
+    def fill_records(**fields):
+        return [(record[0], record[1].format(**fields), 0) if has_fields else record
+                for record, has_fields in parts]
+    return code.format, fill_records
+
+# コマンドごとのアセンブリのテンプレート
+ASM_SOURCES = {
+    "bootstrap": """
+        @256
+        D=A
+        @SP
+        M=D
+        """,
+
+    # 算術論理コマンド(スタックをすべてRAMに置く場合)
+    "add": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        M=D+M
+        @SP
+        M=M+1
+        """,
+    "sub": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        M=M-D
+        @SP
+        M=M+1
+        """,
+    "neg": """
+        @SP
+        M=M-1
+        A=M
+        M=-M
+        @SP
+        M=M+1
+        """,
+    "and": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        M=D&M
+        @SP
+        M=M+1
+        """,
+    "or": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        M=D|M
+        @SP
+        M=M+1
+        """,
+    "not": """
+        @SP
+        M=M-1
+        A=M
+        M=!M
+        @SP
+        M=M+1
+        """,
+    "compare": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @SP
+        M=M-1
+        A=M
+        D=M-D
+        @{scope}$Jmp_{n}
+        D;{jump}
+        @SP
+        A=M
+        M=0
+        @{scope}$end_{n}
+        0;JMP
+        ({scope}$Jmp_{n})
+        @SP
+        A=M
+        M=-1
+        ({scope}$end_{n})
+        @SP
+        M=M+1
+        """,
+
+    # push/pop(スタックをすべてRAMに置く場合)
+    "push_constant": """
+        @{index}
+        D=A
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        """,
+    "push_segment": """
+        @{seg}
+        D=M
+        @{index}
+        A=D+A
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        """,
+    "push_direct": """
+        @{addr}
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        """,
+    "pop_segment": """
+        @{seg}
+        D=M
+        @{index}
+        D=D+A
+        @R13
+        M=D
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @R13
+        A=M
+        M=D
+        """,
+    "pop_direct": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @{addr}
+        M=D
+        """,
+
+    # プログラムフロー
+    "label": """
+        ({label})
+        """,
+    "goto": """
+        @{label}
+        0;JMP
+        """,
+    "if": """
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @{label}
+        D;JNE
+        """,
+    "if_cached": """
+        @{label}
+        D;JNE
+        """,
+
+    # 関数呼び出し
+    "function": """
+        ({name})
+        """,
+    "push_zero": """
+        @SP
+        A=M
+        M=0
+        @SP
+        M=M+1
+        """,
+    "call": """
+        @{ret}
+        D=A
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @LCL
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @ARG
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @THIS
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @THAT
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @SP
+        D=M
+        @5
+        D=D-A
+        @{n_args}
+        D=D-A
+        @ARG
+        M=D
+        @SP
+        D=M
+        @LCL
+        M=D
+        @{name}
+        0;JMP
+        ({ret})
+        """,
+    "return": """
+        @LCL
+        D=M
+        @13
+        M=D
+        @5
+        A=D-A
+        D=M
+        @14
+        M=D
+        @SP
+        M=M-1
+        A=M
+        D=M
+        @ARG
+        A=M
+        M=D
+        D=A
+        @SP
+        M=D+1
+        @13
+        D=M
+        @1
+        A=D-A
+        D=M
+        @THAT
+        M=D
+        @13
+        D=M
+        @2
+        A=D-A
+        D=M
+        @THIS
+        M=D
+        @13
+        D=M
+        @3
+        A=D-A
+        D=M
+        @ARG
+        M=D
+        @13
+        D=M
+        @4
+        A=D-A
+        D=M
+        @LCL
+        M=D
+        @14
+        A=M
+        0;JMP
+        """,
+
+    # スタック先頭をDに保持する場合
+    "spill_tos": """
+        @SP
+        M=M+1
+        A=M-1
+        M=D
+        """,
+    "load_tos": """
+        @SP
+        AM=M-1
+        D=M
+        """,
+    "cached_binary": """
+        @SP
+        AM=M-1
+        {op}
+        """,
+    "cached_unary": """
+        {op}
+        """,
+    "cached_compare": """
+        @SP
+        AM=M-1
+        D=M-D
+        @{scope}$Jmp_{n}
+        D;{jump}
+        D=0
+        @{scope}$end_{n}
+        0;JMP
+        ({scope}$Jmp_{n})
+        D=-1
+        ({scope}$end_{n})
+        """,
+    "segment_address_0": """
+        @{seg}
+        A=M
+        """,
+    "segment_address": """
+        @{seg}
+        A=M+1
+        """,
+    "next_address": """
+        A=A+1
+        """,
+    "load_small_constant": """
+        D={index}
+        """,
+    "load_constant": """
+        @{index}
+        D=A
+        """,
+    "load_segment": """
+        @{seg}
+        D=M
+        @{index}
+        A=D+A
+        D=M
+        """,
+    "load_direct": """
+        @{addr}
+        D=M
+        """,
+    "load_m": """
+        D=M
+        """,
+    "store_segment": """
+        @R13
+        M=D
+        @{seg}
+        D=M
+        @{index}
+        D=D+A
+        @R14
+        M=D
+        @R13
+        D=M
+        @R14
+        A=M
+        M=D
+        """,
+    "store_direct": """
+        @{addr}
+        M=D
+        """,
+    "store_m": """
+        M=D
+        """,
+
+    # 融合パターン
+    "inc_segment": """
+        @{seg}
+        D=M
+        @{index}
+        A=D+A
+        {op}
+        """,
+    "inc_segment_k": """
+        @{seg}
+        D=M
+        @{index}
+        D=D+A
+        @R13
+        M=D
+        @{k}
+        D=A
+        @R13
+        A=M
+        {op}
+        """,
+    "inc_direct": """
+        @{addr}
+        {op}
+        """,
+    "operation": """
+        {op}
+        """,
+    "compare_branch": """
+        @SP
+        AM=M-1
+        D=M
+        @SP
+        AM=M-1
+        D=M-D
+        @{label}
+        D;{jump}
+        """,
+    "cached_compare_branch": """
+        @SP
+        AM=M-1
+        D=M-D
+        @{label}
+        D;{jump}
+        """,
+    "add_const_cached": """
+        @{k}
+        {op}
+        """,
+    "add_const_1": """
+        @SP
+        A=M-1
+        {op}
+        """,
+    "add_const": """
+        @{k}
+        D=A
+        @SP
+        A=M-1
+        {op}
+        """,
+    "neg_const": """
+        @SP
+        M=M+1
+        A=M-1
+        M={value}
+        """,
+
+    # 共有ルーチン
+    "shared_call_no_args": """
+        @R13
+        M=0
+        """,
+    "shared_call_args": """
+        @{n_args}
+        D=A
+        @R13
+        M=D
+        """,
+    "shared_call": """
+        @{name}
+        D=A
+        @R14
+        M=D
+        @{ret}
+        D=A
+        @{routine}
+        0;JMP
+        ({ret})
+        """,
+    "shared_compare": """
+        @{ret}
+        D=A
+        @{routine}
+        0;JMP
+        ({ret})
+        """,
+    "return_jump": """
+        @{routine}
+        0;JMP
+        """,
+    "compare_routine": """
+        ({routine})
+        @R15
+        M=D
+        @SP
+        AM=M-1
+        D=M
+        A=A-1
+        D=M-D
+        M=-1
+        @{routine}$true
+        D;{jump}
+        @SP
+        A=M-1
+        M=0
+        ({routine}$true)
+        @R15
+        A=M
+        0;JMP
+        """,
+    "call_routine": """
+        ({routine})
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @LCL
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @ARG
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @THIS
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @THAT
+        D=M
+        @SP
+        A=M
+        M=D
+        @SP
+        M=M+1
+        @SP
+        D=M
+        @5
+        D=D-A
+        @R13
+        D=D-M
+        @ARG
+        M=D
+        @SP
+        D=M
+        @LCL
+        M=D
+        @R14
+        A=M
+        0;JMP
+        """,
+    "routine_label": """
+        ({routine})
+        """,
+    "halt": """
+        ({label})
+        @{label}
+        0;JMP
+        """,
+}
+_COMPILED_TEMPLATES = {name: compile_template(text) for name, text in ASM_SOURCES.items()}
+ASM_TEMPLATES = {name: compiled[0] for name, compiled in _COMPILED_TEMPLATES.items()}
+ASM_RECORDS = {name: compiled[1] for name, compiled in _COMPILED_TEMPLATES.items()}
+
 
 class CodeWriter:
-    def __init__(self, file_path: str):
+    # shared_call=True の場合、call/returnは共有ルーチンへのジャンプとして出力する
+    # shared_compare=True の場合、eq/gt/ltは共有比較ルーチンへのジャンプとして出力する
+    # cache_tos=True の場合、スタックの先頭をDレジスタに保持したまま次のコマンドへ進む
+    # fuse=True の場合、writeCommandsでよく現れるコマンド列を融合する
+    # 出力はバッファにため、vmファイルごとに1回だけファイルへ書き込む
+    # file_pathがNoneの場合はファイルに書かず、takeCodeでコードを受け取る
+    # records=True の場合はテキストの代わりにアセンブラの命令レコードのリストを出力する(file_pathはNone)
+    # bootstrap=False の場合はブートストラップコードを出力しない(ファイル単位の変換用)
+    # ラベルはファイル名で区切り、番号はファイルごとに0から振るので、各ファイルの変換結果は他のファイルに依存しない
+    def __init__(self, file_path, shared_call=False, shared_compare=False,
+                 cache_tos=False, fuse=False, bootstrap=True, records=False):
         self.file_path = file_path
-        self.file_name = ""
-        self.fp = open(file_path, "w")
-        self.cur_line = ""
+        self.file_name = BOOTSTRAP_SCOPE
+        self.fp = open(file_path, "w") if file_path is not None else None
+        self.buffer = []
+        self.records = records
+        self.templates = ASM_RECORDS if records else ASM_TEMPLATES
+        # テキストは文字列ごと、命令レコードはリストを展開してバッファに追加する
+        self.write = self.buffer.extend if records else self.buffer.append
         self.label_counter = 0
-        asm_code = """
-            @256
-            D=A
-            @SP
-            M=D
-            """
-        self.fp.write(asm_code)
-        self.writeCall("Sys.init", 0)
+        self.shared_call = shared_call
+        self.uses_call_routine = False
+        self.uses_return_routine = False
+        self.shared_compare = shared_compare
+        self.used_compare_routines = set()
+        self.cache_tos = cache_tos
+        self.tos_in_d = False
+        self.fuse = fuse
+        self.fusion_hits = {"inc": 0, "add_const": 0, "move": 0, "neg_const": 0,
+                            "compare_branch": 0}
+        if bootstrap:
+            self.write(self.templates["bootstrap"])
+            self.writeCall("Sys.init", 0)
 
     def close(self):
-        self.fp.close()
+        self.writeSharedRoutines()
+        self.flush()
+        if self.fp is not None:
+            self.fp.close()
+
+    # バッファにたまったコードをまとめて書き込む(ファイルが無い場合はバッファに残す)
+    def flush(self):
+        if self.fp is None:
+            return
+        self.fp.write("".join(self.buffer))
+        self.buffer.clear()
+
+    # バッファにたまったコードを文字列(records=True の場合は命令レコードのリスト)として取り出す
+    def takeCode(self):
+        code = list(self.buffer) if self.records else "".join(self.buffer)
+        self.buffer.clear()
+        return code
 
     # 新しいvmファイルの変換が開始されたことを知らせる
     def setFileName(self, file_path):
+        self.flush()
         self.file_name = os.path.splitext(os.path.basename(file_path))[0]
-        print(f"{self.file_name}の変換開始")
+        self.label_counter = 0
+
+    # 別に変換したファイルのコードと、そのコードが使う共有ルーチンを追加する
+    def writeFragment(self, code: str, routines):
+        self.write(code)
+        self.flush()
+        self.addRoutines(routines)
+
+    # このCodeWriterで使った共有ルーチン (call, return, 比較コマンドの集合)
+    def usedRoutines(self):
+        return (self.uses_call_routine, self.uses_return_routine,
+                frozenset(self.used_compare_routines))
+
+    def addRoutines(self, routines):
+        uses_call, uses_return, compares = routines
+        self.uses_call_routine |= uses_call
+        self.uses_return_routine |= uses_return
+        self.used_compare_routines |= compares
+
+    # コマンドのリストを出力する
+    def writeCommands(self, commands):
+        i = 0
+        n = len(commands)
+        while i < n:
+            if self.fuse:
+                match = match_fusion(commands, i)
+                if match is not None:
+                    pattern, length, params = match
+                    self.writeFused(pattern, params)
+                    self.fusion_hits[pattern] += 1
+                    i += length
+                    continue
+
+            cmd_type, arg1, arg2 = commands[i]
+            i += 1
+            if cmd_type == C_ARITHMETIC:
+                self.WriteArithmetic(arg1)
+            elif cmd_type in [C_POP, C_PUSH]:
+                self.WritePushPop(cmd_type, arg1, arg2)
+            elif cmd_type == C_LABEL:
+                self.writeLabel(arg1)
+            elif cmd_type == C_GOTO:
+                self.writeGoto(arg1)
+            elif cmd_type == C_IF:
+                self.writeIf(arg1)
+            elif cmd_type == C_CALL:
+                self.writeCall(arg1, arg2)
+            elif cmd_type == C_FUNCTION:
+                self.writeFunction(arg1, arg2)
+            elif cmd_type == C_RETURN:
+                self.writeReturn()
+
+    # ファイル内で連番のラベル番号を返す
+    def nextLabel(self) -> int:
+        n = self.label_counter
+        self.label_counter += 1
+        return n
 
     # 算術論理コマンドのcmdに対応するアセンブリコードを出力ファイルに書き込む
     def WriteArithmetic(self, cmd: str):
-
-        if cmd == "add":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                M=D+M
-                @SP
-                M=M+1
-                """
-        elif cmd == "sub":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                M=M-D
-                @SP
-                M=M+1"""
-        elif cmd == "neg":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                M=-M
-                @SP
-                M=M+1
-                """
-        elif cmd == "eq":
-            jump_label = f"Jmp_{self.label_counter}"
-            end_label = f"end_{self.label_counter}"
-            self.label_counter += 1
-            asm_code = f"""
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                D=M-D
-                @{jump_label}
-                D;JEQ
-                @SP
-                A=M
-                M=0
-                @{end_label}
-                0;JMP
-                ({jump_label})
-                @SP
-                A=M
-                M=-1
-                ({end_label})
-                @SP
-                M=M+1
-                """
-        elif cmd == "gt":
-            jump_label = f"Jmp_{self.label_counter}"
-            end_label = f"end_{self.label_counter}"
-            self.label_counter += 1
-            asm_code = f"""
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                D=M-D
-                @{jump_label}
-                D;JGT
-                @SP
-                A=M
-                M=0
-                @{end_label}
-                0;JMP
-                ({jump_label})
-                @SP
-                A=M
-                M=-1
-                ({end_label})
-                @SP
-                M=M+1
-                """
-        elif cmd == "lt":
-            jump_label = f"Jmp_{self.label_counter}"
-            end_label = f"end_{self.label_counter}"
-            self.label_counter += 1
-            asm_code = f"""
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                D=M-D
-                @{jump_label}
-                D;JLT
-                @SP
-                A=M
-                M=0
-                @{end_label}
-                0;JMP
-                ({jump_label})
-                @SP
-                A=M
-                M=-1
-                ({end_label})
-                @SP
-                M=M+1
-                """
-        elif cmd == "and":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                M=D&M
-                @SP
-                M=M+1
-                """   
-        elif cmd == "or":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                D=M
-                @SP
-                M=M-1
-                A=M
-                M=D|M
-                @SP
-                M=M+1
-                """   
-        elif cmd == "not":
-            asm_code = """
-                @SP
-                M=M-1
-                A=M
-                M=!M
-                @SP
-                M=M+1
-                """   
-        self.fp.write(asm_code)
+        if self.cache_tos and not (self.shared_compare and cmd in COMPARE_ROUTINES):
+            self.writeCachedArithmetic(cmd)
+            return
+        self.spillTOS()
+        if cmd in COMPARE_ROUTINES:
+            if self.shared_compare:
+                self.writeSharedCompare(cmd)
+                return
+            _, jump = COMPARE_ROUTINES[cmd]
+            self.write(self.templates["compare"](
+                scope=self.file_name, n=self.nextLabel(), jump=jump))
+            return
+        self.write(self.templates[cmd])
 
     # push, popのcommandに対応するアセンブリコードを出力ファイルに書き込む
     def WritePushPop(self, cmd: int, segment, index):
         index = int(index)
+        if self.cache_tos:
+            self.writeCachedPushPop(cmd, segment, index)
+            return
 
         if cmd == C_PUSH:
-
             if segment == "constant":
-                asm_code = f"""
-                    @{index}
-                    D=A
-                    @SP
-                    A=M
-                    M=D
-                    @SP
-                    M=M+1
-                    """
-                
-            elif segment in ["local", "argument", "this", "that"]:
-                seg_map = {
-                    "local": "LCL",
-                    "argument": "ARG",
-                    "this": "THIS",
-                    "that": "THAT"
-                }
-                seg = seg_map[segment]
-                asm_code = f"""
-                    @{seg}
-                    D=M
-                    @{index}
-                    A=D+A
-                    D=M
-                    @SP
-                    A=M
-                    M=D
-                    @SP
-                    M=M+1
-                    """ 
-            elif segment == "temp":
-                addr = index + 5
-                asm_code = f"""
-                    @{addr}
-                    D=M
-                    @SP
-                    A=M
-                    M=D
-                    @SP
-                    M=M+1
-                    """
-            elif segment == "static":
-                asm_code = f"""
-                    @{self.file_name}.{index}
-                    D=M
-                    @SP
-                    A=M
-                    M=D
-                    @SP
-                    M=M+1
-                    """
-            elif segment == "pointer":
-                addr = "THIS" if index == 0 else "THAT"
-                asm_code = f"""
-                    @{addr}
-                    D=M
-                    @SP
-                    A=M
-                    M=D
-                    @SP
-                    M=M+1
-                    """
+                asm_code = self.templates["push_constant"](index=index)
+            elif segment in SEGMENT_BASES:
+                asm_code = self.templates["push_segment"](
+                    seg=SEGMENT_BASES[segment], index=index)
+            else:
+                asm_code = self.templates["push_direct"](
+                    addr=self.directAddress(segment, index))
         elif cmd == C_POP:
-            if segment in ["local", "argument", "this", "that"]:
-                seg_map = {
-                    "local": "LCL",
-                    "argument": "ARG",
-                    "this": "THIS",
-                    "that": "THAT"
-                }
-                seg = seg_map[segment]
-                asm_code = f"""
-                    @{seg}
-                    D=M
-                    @{index}
-                    D=D+A
-                    @R13
-                    M=D
-                    @SP
-                    M=M-1
-                    A=M
-                    D=M
-                    @R13
-                    A=M
-                    M=D
-                    """
-            elif segment == "temp":
-                addr = index + 5
-                asm_code = f"""
-                    @SP
-                    M=M-1
-                    A=M
-                    D=M
-                    @{addr}
-                    M=D
-                    """
-            elif segment == "static":
-                asm_code = f"""
-                    @SP
-                    M=M-1
-                    A=M
-                    D=M
-                    @{self.file_name}.{index}
-                    M=D
-                    """
-            elif segment == "pointer":
-                addr = "THIS" if index == 0 else "THAT"
-                asm_code = f"""
-                    @SP
-                    M=M-1
-                    A=M
-                    D=M
-                    @{addr}
-                    M=D
-                    """
-        self.fp.write(asm_code)    
+            if segment in SEGMENT_BASES:
+                asm_code = self.templates["pop_segment"](
+                    seg=SEGMENT_BASES[segment], index=index)
+            else:
+                asm_code = self.templates["pop_direct"](
+                    addr=self.directAddress(segment, index))
+        self.write(asm_code)
 
     # ラベルコマンドの実装
     def writeLabel(self, label: str):
-        asm_code = f"""
-            ({label})
-            """
-        self.fp.write(asm_code)
+        self.spillTOS()
+        self.write(self.templates["label"](label=label))
 
     # gotoコマンドの実装
     def writeGoto(self, label: str):
-        asm_code = f"""
-            @{label}
-            0;JMP
-            """
-        self.fp.write(asm_code)
+        self.spillTOS()
+        self.write(self.templates["goto"](label=label))
 
     # if-gotoの実装
     def writeIf(self, label: str):
-        asm_code = f"""
-            @SP
-            M=M-1
-            A=M
-            D=M
-            @{label}
-            D;JNE
-            """
-        self.fp.write(asm_code)
+        if self.cache_tos:
+            self.loadTOS()
+            self.tos_in_d = False
+            self.write(self.templates["if_cached"](label=label))
+            return
+        self.write(self.templates["if"](label=label))
 
     # functionコマンドの実装
     def writeFunction(self, functionName: str, nVars: int):
-        asm_code = f"""
-            ({functionName})
-            """
-        for i in range(nVars):
-            asm_code +=  """
-                @SP
-                A=M
-                M=0
-                @SP
-                M=M+1
-                """
-        self.fp.write(asm_code)
+        self.spillTOS()
+        self.write(self.templates["function"](name=functionName)
+                           + self.templates["push_zero"] * nVars)
 
     # callコマンドの実装
     def writeCall(self, functionName: str, nArgs: int):
-        asm_code = f"""
-            @{functionName}$ret.{self.label_counter}
-            D=A
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            @LCL
-            D=M
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            @ARG
-            D=M
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            @THIS
-            D=M
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            @THAT
-            D=M
-            @SP
-            A=M
-            M=D
-            @SP
-            M=M+1
-            @SP
-            D=M
-            @5
-            D=D-A
-            @{nArgs}
-            D=D-A
-            @ARG
-            M=D
-            @SP
-            D=M
-            @LCL
-            M=D
-            @{functionName}
-            0;JMP
-            ({functionName}$ret.{self.label_counter})
-            """
-        self.label_counter += 1
-        self.fp.write(asm_code)
+        self.spillTOS()
+        if self.shared_call:
+            self.writeSharedCall(functionName, nArgs)
+            return
+        return_label = f"{self.file_name}$ret.{self.nextLabel()}"
+        self.write(self.templates["call"](
+            name=functionName, n_args=nArgs, ret=return_label))
 
     # return コマンドの実装
     def writeReturn(self):
-        asm_code = f"""
-            @LCL
-            D=M
-            @13
-            M=D
-            @5
-            A=D-A
-            D=M
-            @14
-            M=D
-            @SP
-            M=M-1
-            A=M
-            D=M
-            @ARG
-            A=M
-            M=D
-            D=A
-            @SP
-            M=D+1
-            @13
-            D=M
-            @1
-            A=D-A
-            D=M
-            @THAT
-            M=D
-            @13
-            D=M
-            @2
-            A=D-A
-            D=M
-            @THIS
-            M=D
-            @13
-            D=M
-            @3
-            A=D-A
-            D=M
-            @ARG
-            M=D 
-            @13
-            D=M
-            @4
-            A=D-A
-            D=M
-            @LCL
-            M=D
-            @14
-            A=M
-            0;JMP
-            """
-        self.fp.write(asm_code)
+        self.spillTOS()
+        if self.shared_call:
+            self.uses_return_routine = True
+            self.write(self.templates["return_jump"](routine=RETURN_ROUTINE))
+            return
+        self.write(self.templates["return"])
+
+    # Dに保持しているスタックの先頭をRAMに書き戻す
+    # ラベル、分岐、call、return、関数の境界ではスタックはすべてRAM上にある
+    def spillTOS(self):
+        if not self.tos_in_d:
+            return
+        self.tos_in_d = False
+        self.write(self.templates["spill_tos"])
+
+    # スタックの先頭をDに読み込む(まだDに無い場合)
+    def loadTOS(self):
+        if self.tos_in_d:
+            return
+        self.tos_in_d = True
+        self.write(self.templates["load_tos"])
+
+    # スタック先頭をDに保持する場合の算術論理コマンド
+    def writeCachedArithmetic(self, cmd: str):
+        binary = {"add": "D=D+M", "sub": "D=M-D", "and": "D=D&M", "or": "D=D|M"}
+        unary = {"neg": "D=-D", "not": "D=!D"}
+        self.loadTOS()
+
+        if cmd in binary:
+            asm_code = self.templates["cached_binary"](op=binary[cmd])
+        elif cmd in unary:
+            asm_code = self.templates["cached_unary"](op=unary[cmd])
+        else:
+            _, jump = COMPARE_ROUTINES[cmd]
+            asm_code = self.templates["cached_compare"](
+                scope=self.file_name, n=self.nextLabel(), jump=jump)
+        self.write(asm_code)
+
+    # 基底ポインタ+indexのアドレスをAに入れるコード(Dは壊さない)
+    def segmentAddress(self, seg: str, index: int):
+        if index == 0:
+            return self.templates["segment_address_0"](seg=seg)
+        return (self.templates["segment_address"](seg=seg)
+                + self.templates["next_address"] * (index - 1))
+
+    # temp/static/pointerセグメントの直接アドレス(基底ポインタを持つセグメントはNone)
+    def directAddress(self, segment, index: int):
+        if segment == "temp":
+            return str(index + 5)
+        elif segment == "static":
+            return f"{self.file_name}.{index}"
+        elif segment == "pointer":
+            return "THIS" if index == 0 else "THAT"
+        return None
+
+    # segment[index]の値をDに読み込むコード
+    def loadSegmentCode(self, segment, index: int):
+        if segment == "constant":
+            if index in (0, 1):
+                return self.templates["load_small_constant"](index=index)
+            return self.templates["load_constant"](index=index)
+        elif segment in SEGMENT_BASES:
+            if index <= 1:
+                return (self.segmentAddress(SEGMENT_BASES[segment], index)
+                        + self.templates["load_m"])
+            return self.templates["load_segment"](seg=SEGMENT_BASES[segment], index=index)
+        return self.templates["load_direct"](addr=self.directAddress(segment, index))
+
+    # Dの値をsegment[index]に書き込むコード
+    def storeSegmentCode(self, segment, index: int):
+        if segment in SEGMENT_BASES:
+            if index <= 3:
+                return (self.segmentAddress(SEGMENT_BASES[segment], index)
+                        + self.templates["store_m"])
+            return self.templates["store_segment"](seg=SEGMENT_BASES[segment], index=index)
+        return self.templates["store_direct"](addr=self.directAddress(segment, index))
+
+    # スタック先頭をDに保持する場合のpush/pop
+    def writeCachedPushPop(self, cmd: int, segment, index: int):
+        if cmd == C_PUSH:
+            self.spillTOS()
+            self.tos_in_d = True
+            asm_code = self.loadSegmentCode(segment, index)
+        else:
+            self.loadTOS()
+            self.tos_in_d = False
+            asm_code = self.storeSegmentCode(segment, index)
+        self.write(asm_code)
+
+    # 融合パターン(match_fusionを参照)をスタック操作なしのコードとして出力する
+    def writeFused(self, pattern: str, params):
+        if pattern == "inc":
+            segment, index, op, k = params
+            self.spillTOS()
+            if k == 1:
+                operation = "M=M+1" if op == "add" else "M=M-1"
+                if segment in SEGMENT_BASES and index > 3:
+                    asm_code = self.templates["inc_segment"](
+                        seg=SEGMENT_BASES[segment], index=index, op=operation)
+                elif segment in SEGMENT_BASES:
+                    asm_code = (self.segmentAddress(SEGMENT_BASES[segment], index)
+                                + self.templates["operation"](op=operation))
+                else:
+                    asm_code = self.templates["inc_direct"](
+                        addr=self.directAddress(segment, index), op=operation)
+            else:
+                operation = "M=D+M" if op == "add" else "M=M-D"
+                if segment in SEGMENT_BASES and index > 3:
+                    asm_code = self.templates["inc_segment_k"](
+                        seg=SEGMENT_BASES[segment], index=index, k=k, op=operation)
+                elif segment in SEGMENT_BASES:
+                    asm_code = (self.templates["load_constant"](index=k)
+                                + self.segmentAddress(SEGMENT_BASES[segment], index)
+                                + self.templates["operation"](op=operation))
+                else:
+                    asm_code = (self.templates["load_constant"](index=k)
+                                + self.templates["inc_direct"](
+                                    addr=self.directAddress(segment, index), op=operation))
+        elif pattern == "add_const":
+            op, k = params
+            if self.cache_tos:
+                self.loadTOS()
+                operation = "D=D+A" if op == "add" else "D=D-A"
+                asm_code = self.templates["add_const_cached"](k=k, op=operation)
+            elif k == 1:
+                operation = "M=M+1" if op == "add" else "M=M-1"
+                asm_code = self.templates["add_const_1"](op=operation)
+            else:
+                operation = "M=D+M" if op == "add" else "M=M-D"
+                asm_code = self.templates["add_const"](k=k, op=operation)
+        elif pattern == "move":
+            src_segment, src_index, dst_segment, dst_index = params
+            self.spillTOS()
+            asm_code = (self.loadSegmentCode(src_segment, src_index)
+                        + self.storeSegmentCode(dst_segment, dst_index))
+        elif pattern == "neg_const":
+            (k,) = params
+            value = "-1" if k == 1 else "0"
+            if self.cache_tos:
+                self.spillTOS()
+                self.tos_in_d = True
+                asm_code = self.templates["load_small_constant"](index=value)
+            else:
+                asm_code = self.templates["neg_const"](value=value)
+        elif pattern == "compare_branch":
+            cmd, negate, label = params
+            _, jump = COMPARE_ROUTINES[cmd]
+            if negate:
+                jump = NEGATED_JUMPS[jump]
+            if self.cache_tos:
+                self.loadTOS()
+                self.tos_in_d = False
+                asm_code = self.templates["cached_compare_branch"](label=label, jump=jump)
+            else:
+                asm_code = self.templates["compare_branch"](label=label, jump=jump)
+        self.write(asm_code)
+
+    # 共有callルーチンへのジャンプ
+    # 呼び出し側は引数の数をR13、呼び出し先をR14、戻りアドレスをDに入れてジャンプする
+    def writeSharedCall(self, functionName: str, nArgs: int):
+        self.uses_call_routine = True
+        return_label = f"{self.file_name}$ret.{self.nextLabel()}"
+        if nArgs == 0:
+            set_args = self.templates["shared_call_no_args"]
+        else:
+            set_args = self.templates["shared_call_args"](n_args=nArgs)
+        self.write(set_args + self.templates["shared_call"](
+            name=functionName, ret=return_label, routine=CALL_ROUTINE))
+
+    # 共有比較ルーチンへのジャンプ。戻りアドレスはDで渡し、ルーチン側でR15に退避する
+    def writeSharedCompare(self, cmd: str):
+        routine, _ = COMPARE_ROUTINES[cmd]
+        self.used_compare_routines.add(cmd)
+        return_label = f"{self.file_name}$cmp_ret_{self.nextLabel()}"
+        self.write(self.templates["shared_compare"](
+            ret=return_label, routine=routine))
+
+    # プログラムの終わりの停止ループ
+    def writeHalt(self):
+        self.write(self.templates["halt"](label=f"{BOOTSTRAP_SCOPE}$halt"))
+
+    # 使われた共有ルーチンを出力の末尾に1度だけ書き込む
+    def writeSharedRoutines(self):
+        for cmd in sorted(self.used_compare_routines):
+            routine, jump = COMPARE_ROUTINES[cmd]
+            self.write(self.templates["compare_routine"](
+                routine=routine, jump=jump))
+        self.used_compare_routines.clear()
+        if self.uses_call_routine:
+            self.write(self.templates["call_routine"](routine=CALL_ROUTINE))
+            self.uses_call_routine = False
+        if self.uses_return_routine:
+            self.write(self.templates["routine_label"](routine=RETURN_ROUTINE)
+                               + self.templates["return"])
+            self.uses_return_routine = False
+
+
+# 融合の対象にできるpush/popのセグメント
+FUSABLE_SEGMENTS = ("local", "argument", "this", "that", "static", "temp", "pointer")
+
+# commands[i]から始まる融合パターンを探す
+# 一致した場合は (パターン名, 消費したコマンド数, パラメータ) を、それ以外はNoneを返す
+#   inc:       push S i; push constant k; add|sub; pop S i  -> S[i]を直接更新
+#   add_const: push constant k; add|sub                     -> スタック先頭を直接更新
+#   move:      push X; pop Y                                -> Dを経由して直接コピー
+#   neg_const: push constant 0|1; neg                       -> 定数0/-1をpush
+#   compare_branch: eq|gt|lt; [not]; if-goto L              -> 差を1回計算して条件ジャンプ
+def match_fusion(commands, i):
+    cmd_type, arg1, arg2 = commands[i]
+    if cmd_type == C_ARITHMETIC and arg1 in COMPARE_ROUTINES:
+        rest = commands[i + 1:i + 3]
+        negate = bool(rest) and rest[0] == (C_ARITHMETIC, "not", None)
+        if negate:
+            rest = rest[1:]
+        if rest and rest[0][0] == C_IF:
+            return ("compare_branch", 3 if negate else 2, (arg1, negate, rest[0][1]))
+        return None
+    if cmd_type != C_PUSH:
+        return None
+    rest = commands[i + 1:i + 4]
+
+    if (arg1 in FUSABLE_SEGMENTS and len(rest) == 3
+            and rest[0][:2] == (C_PUSH, "constant")
+            and rest[1][0] == C_ARITHMETIC and rest[1][1] in ("add", "sub")
+            and rest[2] == (C_POP, arg1, arg2)):
+        return ("inc", 4, (arg1, arg2, rest[1][1], rest[0][2]))
+
+    if arg1 == "constant" and rest:
+        nxt = rest[0]
+        if nxt[0] == C_ARITHMETIC and nxt[1] in ("add", "sub"):
+            return ("add_const", 2, (nxt[1], arg2))
+        if nxt[0] == C_ARITHMETIC and nxt[1] == "neg" and arg2 in (0, 1):
+            return ("neg_const", 2, (arg2,))
+
+    if rest and rest[0][0] == C_POP:
+        return ("move", 2, (arg1, arg2, rest[0][1], rest[0][2]))
+
+    return None
+
+# 関数ごとの呼び出し先を集め、(関数名 -> 呼び出す関数の集合, トップレベルのコードが呼び出す関数の集合) を返す
+# 最初のfunctionより前のコマンドはファイルのトップレベルのコードとする
+def collect_calls(commands):
+    calls = {}
+    top_level = set()
+    current = top_level
+    for cmd_type, arg1, _ in commands:
+        if cmd_type == C_FUNCTION:
+            current = calls.setdefault(arg1, set())
+        elif cmd_type == C_CALL:
+            current.add(arg1)
+    return calls, top_level
+
+# rootとトップレベルのコードから呼び出しをたどって到達できる関数の集合を返す
+# rootが定義されていない場合は全体を把握できないのでNoneを返す
+def reachable_functions(programs, root="Sys.init"):
+    calls = {}
+    roots = {root}
+    for commands in programs:
+        file_calls, top_level = collect_calls(commands)
+        calls.update(file_calls)
+        roots |= top_level
+    if root not in calls:
+        return None
+
+    reachable = set()
+    stack = [name for name in roots if name in calls]
+    while stack:
+        name = stack.pop()
+        if name in reachable:
+            continue
+        reachable.add(name)
+        stack.extend(callee for callee in calls[name] if callee in calls)
+    return reachable
+
+# 指定した関数の本体を取り除き、(残すコマンド, 取り除いたコマンド) を返す
+def split_dead_functions(commands, dead_functions):
+    live = []
+    dead = []
+    target = live
+    for command in commands:
+        if command[0] == C_FUNCTION:
+            target = dead if command[1] in dead_functions else live
+        target.append(command)
+    return live, dead
+
+# CodeWriterの出力(テキストまたは命令レコード)のROMワード数(ラベルを除いた命令数)
+def count_words(code) -> int:
+    if isinstance(code, str):
+        return sum(1 for line in code.splitlines() if line[0] != '(')
+    return sum(1 for record in code if record[0] != L_INSTRUCTION)
+
+# コマンド列を変換したときのROMワード数
+def code_words(commands, options, vm_path="Scratch"):
+    scratch = CodeWriter(None, bootstrap=False, **options)
+    scratch.setFileName(vm_path)
+    scratch.writeCommands(commands)
+    scratch.spillTOS()
+    return count_words(scratch.takeCode())
+
+# 算術論理コマンドが必要とするスタックの値の数と、実行後のスタックの深さの変化
+ARITHMETIC_STACK_EFFECTS = {
+    "add": (2, -1), "sub": (2, -1), "eq": (2, -1), "gt": (2, -1), "lt": (2, -1),
+    "and": (2, -1), "or": (2, -1), "neg": (1, 0), "not": (1, 0),
+}
+
+# 関数本体の各コマンドでのスタックの深さが経路によらず決まり、
+# すべてのreturnで戻り値だけがスタックに残っているかを調べる
+def check_stack_depth(body):
+    labels = {arg1: i for i, (cmd_type, arg1, _) in enumerate(body) if cmd_type == C_LABEL}
+    depth = [None] * len(body)
+    work = [(0, 0)]
+    while work:
+        i, d = work.pop()
+        while i < len(body):
+            if depth[i] is not None:
+                if depth[i] != d:
+                    return False
+                break
+            depth[i] = d
+            cmd_type, arg1, _ = body[i]
+            if cmd_type == C_RETURN:
+                if d != 1:
+                    return False
+                break
+            if cmd_type == C_PUSH:
+                need, delta = 0, 1
+            elif cmd_type == C_POP or cmd_type == C_IF:
+                need, delta = 1, -1
+            elif cmd_type == C_ARITHMETIC:
+                need, delta = ARITHMETIC_STACK_EFFECTS[arg1]
+            else:
+                need, delta = 0, 0
+            if d < need:
+                return False
+            d += delta
+            if cmd_type == C_GOTO or cmd_type == C_IF:
+                if arg1 not in labels:
+                    return False
+                work.append((labels[arg1], d))
+                if cmd_type == C_GOTO:
+                    break
+            i += 1
+        else:
+            # returnせずに関数の終わりに達する
+            return False
+    return True
+
+# インライン展開できる関数を集める
+# callを含まず、function/returnを除いた本体がmax_commands以下で、スタックの深さが静的に決まる関数を
+# 関数名 -> (ファイル番号, ローカル変数の数, 本体, 使う引数の数, staticを使うか, 書き込むpointerの集合) とする
+def find_inline_candidates(programs, max_commands):
+    candidates = {}
+    for file_index, commands in enumerate(programs):
+        starts = [i for i, command in enumerate(commands) if command[0] == C_FUNCTION]
+        for start, end in zip(starts, starts[1:] + [len(commands)]):
+            _, name, n_vars = commands[start]
+            body = commands[start + 1:end]
+            size = sum(1 for command in body if command[0] != C_RETURN)
+            if size > max_commands or any(command[0] == C_CALL for command in body):
+                continue
+            n_args = 0
+            uses_static = False
+            writes_pointer = set()
+            valid = True
+            for cmd_type, segment, index in body:
+                if cmd_type != C_PUSH and cmd_type != C_POP:
+                    continue
+                if segment == "argument":
+                    n_args = max(n_args, index + 1)
+                elif segment == "local" and index >= n_vars:
+                    valid = False
+                elif segment == "static":
+                    uses_static = True
+                elif segment == "pointer" and cmd_type == C_POP:
+                    writes_pointer.add(index)
+            if valid and check_stack_depth(body):
+                candidates[name] = (file_index, n_vars, body, n_args, uses_static,
+                                    frozenset(writes_pointer))
+    return candidates
+
+# 呼び出しの位置に展開するコマンド列と、使う呼び出し元のローカル変数の数を返す
+# 引数、ローカル変数、書き込むpointerの退避先を呼び出し元のローカル変数base以降に割り当てる
+# ラベルはprefixを付けて呼び出し元の中で一意にする
+def expand_inline(candidate, n_args, base, prefix):
+    _, n_vars, body, _, _, writes_pointer = candidate
+    local_base = base + n_args
+    save_base = local_base + n_vars
+    saves = sorted(writes_pointer)
+
+    expansion = [(C_POP, "local", base + i) for i in reversed(range(n_args))]
+    for j in range(n_vars):
+        expansion.append((C_PUSH, "constant", 0))
+        expansion.append((C_POP, "local", local_base + j))
+    for k, pointer in enumerate(saves):
+        expansion.append((C_PUSH, "pointer", pointer))
+        expansion.append((C_POP, "local", save_base + k))
+
+    end_label = f"{prefix}$end"
+    needs_end = False
+    for pos, (cmd_type, arg1, arg2) in enumerate(body):
+        if (cmd_type == C_PUSH or cmd_type == C_POP) and arg1 == "argument":
+            expansion.append((cmd_type, "local", base + arg2))
+        elif (cmd_type == C_PUSH or cmd_type == C_POP) and arg1 == "local":
+            expansion.append((cmd_type, "local", local_base + arg2))
+        elif cmd_type in (C_LABEL, C_GOTO, C_IF):
+            expansion.append((cmd_type, f"{prefix}.{arg1}", None))
+        elif cmd_type == C_RETURN:
+            # 戻り値はすでにスタックの先頭にある
+            if pos != len(body) - 1:
+                expansion.append((C_GOTO, end_label, None))
+                needs_end = True
+        else:
+            expansion.append((cmd_type, arg1, arg2))
+    if needs_end:
+        expansion.append((C_LABEL, end_label, None))
+
+    for k, pointer in enumerate(saves):
+        expansion.append((C_PUSH, "local", save_base + k))
+        expansion.append((C_POP, "pointer", pointer))
+    return expansion, n_args + n_vars + len(saves)
+
+# 小さな葉関数(他の関数を呼ばない関数)の呼び出しをその本体で置き換える
+# 呼び出し元の関数のローカル変数を増やして、展開した本体の引数とローカル変数に使う
+# staticを使う関数は、staticの名前がファイルで決まるため同じファイルの中でだけ展開する
+# 展開で減るサイクル数が呼び出し元の入口で増えるサイクル数を上回る呼び出しを、
+# ROMの増加がbudgetワードを超えない範囲で、プログラムの先頭から順に展開する
+def inline_functions(programs, options, max_commands=8, budget=512):
+    candidates = find_inline_candidates(programs, max_commands)
+    report = {"sites": 0, "functions": set(), "growth": 0, "saved_cycles": 0,
+              "entry_cycles": 0}
+    call_cost = {}
+    # サイクル数の見積もりでは、共有ルーチンの中で実行される命令も数えるため共有ルーチンを使わない設定で変換する
+    cycle_options = dict(options, shared_call=False, shared_compare=False)
+
+    new_programs = []
+    for file_index, commands in enumerate(programs):
+        result = []
+        # 呼び出し元の関数: [functionコマンドの位置, 名前, ローカル変数の数, 追加したローカル変数の数, 展開した数]
+        caller = None
+
+        def finish_caller():
+            if caller is not None and caller[3]:
+                result[caller[0]] = (C_FUNCTION, caller[1], caller[2] + caller[3])
+
+        for command in commands:
+            cmd_type, arg1, arg2 = command
+            if cmd_type == C_FUNCTION:
+                finish_caller()
+                caller = [len(result), arg1, arg2, 0, 0]
+                result.append(command)
+                continue
+
+            candidate = candidates.get(arg1) if cmd_type == C_CALL else None
+            if (candidate is not None and caller is not None and candidate[3] <= arg2
+                    and (not candidate[4] or candidate[0] == file_index)):
+                prefix = f"{caller[1]}$inline{caller[4]}"
+                expansion, slots = expand_inline(candidate, arg2, caller[2], prefix)
+                new_slots = max(0, slots - caller[3])
+                entry_words = code_words([(C_FUNCTION, "F", new_slots)], options)
+                growth = (code_words(expansion, options) - code_words([command], options)
+                          + entry_words)
+
+                # 1回の呼び出しで減るサイクル数の見積もり(本体が分岐しない場合は正確)
+                # 追加したローカル変数の初期化は呼び出し元の入口で毎回実行される
+                if arg1 not in call_cost:
+                    _, n_vars, body, _, _, _ = candidate
+                    call_cost[arg1] = code_words([(C_FUNCTION, arg1, n_vars)] + body,
+                                                 cycle_options)
+                saved = (code_words([command], cycle_options) + call_cost[arg1]
+                         - code_words(expansion, cycle_options))
+                entry_cycles = code_words([(C_FUNCTION, "F", new_slots)], cycle_options)
+
+                if saved > entry_cycles and report["growth"] + growth <= budget:
+                    report["saved_cycles"] += saved
+                    report["entry_cycles"] += entry_cycles
+                    report["growth"] += growth
+                    report["sites"] += 1
+                    report["functions"].add(arg1)
+                    caller[3] += new_slots
+                    caller[4] += 1
+                    result.extend(expansion)
+                    continue
+            result.append(command)
+        finish_caller()
+        new_programs.append(result)
+    return new_programs, report
+
+# 2項の算術論理コマンドを16ビットの値で計算する関数
+# gt/ltは変換後のコードと同じく差の符号で判定する
+BINARY_FOLDS = {
+    "add": lambda a, b: a + b,
+    "sub": lambda a, b: a - b,
+    "and": lambda a, b: a & b,
+    "or": lambda a, b: a | b,
+    "eq": lambda a, b: -1 if a == b else 0,
+    "gt": lambda a, b: -1 if to_signed(a - b) > 0 else 0,
+    "lt": lambda a, b: -1 if to_signed(a - b) < 0 else 0,
+}
+
+# 16ビットの2の補数として符号付きの値にする
+def to_signed(value: int) -> int:
+    value &= 0xFFFF
+    return value - 0x10000 if value & 0x8000 else value
+
+# 定数をpushするコマンド列。負の値は push constant k; neg、-32768は push constant 32767; not とする
+def encode_constant(value: int):
+    value = to_signed(value)
+    if value >= 0:
+        return [(C_PUSH, "constant", value)]
+    if value == -0x8000:
+        return [(C_PUSH, "constant", 0x7FFF), (C_ARITHMETIC, "not", None)]
+    return [(C_PUSH, "constant", -value), (C_ARITHMETIC, "neg", None)]
+
+# commands[:end]の末尾が定数のpushなら (値, コマンド数) を返す
+# push constant k のほか、push constant k; neg と push constant k; not (Jackのtrueなど) も定数とする
+def constant_at(commands, end: int):
+    if end >= 1 and commands[end - 1][:2] == (C_PUSH, "constant"):
+        return commands[end - 1][2], 1
+    if end >= 2 and commands[end - 2][:2] == (C_PUSH, "constant"):
+        k = commands[end - 2][2]
+        if commands[end - 1] == (C_ARITHMETIC, "neg", None):
+            return -k, 2
+        if commands[end - 1] == (C_ARITHMETIC, "not", None):
+            return ~k, 2
+    return None
+
+# 出力の末尾で適用できる書き換えを1つ行い、行ったかどうかを返す
+def _reduce_tail(out) -> bool:
+    cmd_type, arg1, arg2 = out[-1]
+    n = len(out)
+    if cmd_type == C_ARITHMETIC and arg1 in BINARY_FOLDS:
+        right = constant_at(out, n - 1)
+        if right is None:
+            return False
+        b, nb = right
+        left = constant_at(out, n - 1 - nb)
+        if left is not None:
+            a, na = left
+            folded = encode_constant(BINARY_FOLDS[arg1](a, b))
+            del out[n - 1 - nb - na:]
+            out.extend(folded)
+            return True
+        # x + 0, x - 0, x | 0 はxのまま
+        if b == 0 and arg1 in ("add", "sub", "or"):
+            del out[n - 1 - nb:]
+            return True
+    elif cmd_type == C_ARITHMETIC:
+        if n >= 2 and out[-2] == out[-1]:
+            # not; not と neg; neg は何もしない
+            del out[-2:]
+            return True
+        operand = constant_at(out, n - 1)
+        if operand is not None:
+            value, count = operand
+            folded = encode_constant(-value if arg1 == "neg" else ~value)
+            if len(folded) < count + 1:
+                del out[n - 1 - count:]
+                out.extend(folded)
+                return True
+    elif cmd_type == C_POP:
+        if n >= 2 and out[-2] == (C_PUSH, arg1, arg2):
+            del out[-2:]
+            return True
+    elif cmd_type == C_IF:
+        condition = constant_at(out, n - 1)
+        if condition is not None:
+            value, count = condition
+            del out[n - 1 - count:]
+            if to_signed(value) != 0:
+                out.append((C_GOTO, arg1, None))
+            return True
+    elif cmd_type == C_LABEL:
+        if n >= 2 and out[-2] == (C_GOTO, arg1, None):
+            del out[-2]
+            return True
+        # 比較; not; if-goto L; goto M; label L -> 比較; if-goto M; label L
+        # notはビットごとの否定なので、条件が比較の結果(0か-1)の場合だけ分岐を入れ替えられる
+        if (n >= 5 and out[-5][0] == C_ARITHMETIC and out[-5][1] in COMPARE_ROUTINES
+                and out[-4] == (C_ARITHMETIC, "not", None) and out[-3] == (C_IF, arg1, None)
+                and out[-2][0] == C_GOTO):
+            out[-4:-1] = [(C_IF, out[-2][1], None)]
+            return True
+    return False
+
+# VMコマンド列の覗き穴最適化
+#   定数の畳み込み (push constant a; push constant b; add など)、x+0/x-0/x|0 の除去
+#   not; not / neg; neg の除去、push X; pop X の除去
+#   定数条件のif-gotoをgotoまたは削除に、直後のラベルへのgotoを削除
+#   比較; not; if-goto L; goto M; label L を 比較; if-goto M; label L に
+#   goto/returnの後ろから次のラベルまでの到達しないコマンドを削除
+# 書き換えは連続したコマンドの中だけで行い、ラベルや関数をまたがない
+def optimize_commands(commands):
+    out = []
+    unreachable = False
+    for command in commands:
+        if unreachable:
+            if command[0] != C_LABEL and command[0] != C_FUNCTION:
+                continue
+            unreachable = False
+        out.append(command)
+        while out and _reduce_tail(out):
+            pass
+        unreachable = bool(out) and out[-1][0] in (C_GOTO, C_RETURN)
+    return out
+
+# 1つの.vmファイルを単独で変換し、(コード, 使った共有ルーチン, 融合パターンの回数, 削除したROMワード数,
+# 最適化の統計) を返す
+# dead_functionsの関数は出力しない。削除したワード数を数えるため、それらは別のCodeWriterで変換する
+# commandsを渡した場合はファイルを読まずにそのコマンド列を変換する(インライン展開後など)
+# optimize=True の場合はoptimize_commandsを通し、統計として
+# (VMコマンド数, 最適化後のVMコマンド数, Hack命令数, 最適化後のHack命令数) を返す
+# records=True の場合、コードはテキストではなく命令レコードのリストになる
+# プロセスプールのワーカーから呼ばれる
+def translate_file(vm_path, options, dead_functions=frozenset(), commands=None,
+                   optimize=False, records=False):
+    if commands is None:
+        commands = Parser(vm_path).commands()
+    dropped_words = 0
+    if dead_functions:
+        commands, dead = split_dead_functions(commands, dead_functions)
+        dropped_words = code_words(dead, options, vm_path)
+
+    original = commands
+    if optimize:
+        commands = optimize_commands(commands)
+
+    code_writer = CodeWriter(None, bootstrap=False, records=records, **options)
+    code_writer.setFileName(vm_path)
+    code_writer.writeCommands(commands)
+    # ファイルの終わりでスタックをすべてRAMに戻す
+    code_writer.spillTOS()
+    code = code_writer.takeCode()
+
+    stats = None
+    if optimize:
+        stats = (len(original), len(commands), code_words(original, options, vm_path),
+                 count_words(code))
+    return (code, code_writer.usedRoutines(), code_writer.fusion_hits, dropped_words, stats)
+
+# 06のアセンブラを読み込む。sys.pathは変えず、ファイルから直接モジュールとして読み込む
+def load_assembler():
+    if not os.path.exists(ASSEMBLER_PATH):
+        raise RuntimeError("06/assembler.py が見つかりません")
+    spec = importlib.util.spec_from_file_location("assembler", ASSEMBLER_PATH)
+    assembler = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(assembler)
+    return assembler
+
+# キャッシュのファイル名。ファイルの内容に加えて、コードに現れるファイル名、コード生成の設定、
+# 削除する関数で決まる
+def _cache_file(cache_dir, vm_path, data, options, dead_functions):
+    key = hashlib.sha256()
+    key.update(repr((CACHE_VERSION, os.path.basename(vm_path),
+                     sorted(options.items()), sorted(dead_functions))).encode())
+    key.update(data)
+    return os.path.join(cache_dir, key.hexdigest() + ".pickle")
+
+def _load_cache(cache_file):
+    try:
+        with open(cache_file, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+def _save_cache(cache_file, result):
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    tmp_file = cache_file + ".tmp"
+    with open(tmp_file, 'wb') as f:
+        pickle.dump(result, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_file, cache_file)
 
 class VMTranslator:
-    def __init__(self, input_path):
+    # jobs > 1 の場合、各.vmファイルをプロセスプールで並列に変換する
+    # ファイルは名前順に連結するので、出力は並列数によらず同じになる
+    # cache_dirを指定すると、各ファイルの変換結果をキャッシュし、変更されたファイルだけを変換し直す
+    # dce=True の場合、Sys.initから呼び出しをたどって到達できない関数を出力しない
+    # inline=True の場合、inline_max コマンド以下の葉関数を、ROMの増加が inline_budget ワード以内で展開する
+    # optimize=True の場合、各ファイルのVMコマンド列をoptimize_commandsで最適化してから変換する
+    # bootstrap=False の場合、ブートストラップコードを出力せず、最後のファイルのコードの後ろを停止ループにする
+    # (Sys.initの無い07/08のテストプログラム用。共有ルーチンに実行が流れ込まない)
+    def __init__(self, input_path, shared_call=False, shared_compare=False,
+                 cache_tos=False, fuse=False, jobs=1, cache_dir=None, dce=False,
+                 inline=False, inline_max=8, inline_budget=512, optimize=False,
+                 bootstrap=True):
         self.input_path = input_path
+        self.bootstrap = bootstrap
+        self.options = {
+            "shared_call": shared_call,
+            "shared_compare": shared_compare,
+            "cache_tos": cache_tos,
+            "fuse": fuse,
+        }
+        self.fuse = fuse
+        self.jobs = jobs
+        self.cache_dir = cache_dir
+        self.dce = dce
+        self.inline = inline
+        self.inline_max = inline_max
+        self.inline_budget = inline_budget
+        self.optimize = optimize
+        self.fusion_hits = {"inc": 0, "add_const": 0, "move": 0, "neg_const": 0,
+                            "compare_branch": 0}
+        self.dead_function_count = 0
         
         # 出力ファイル名を決定
         dir_name = os.path.basename(os.path.normpath(input_path))
         self.output_file = os.path.join(input_path, f"{dir_name}.asm")
         
         # .vmファイルのリストを取得
-        self.vm_files = [f for f in os.listdir(input_path) if f.endswith('.vm')]
+        self.vm_files = sorted(f for f in os.listdir(input_path) if f.endswith('.vm'))
         print(f"見つかったファイル: {self.vm_files}")
 
-    def translate(self):
-        # 1つのCodeWriterインスタンスを作成(ブートストラップコード込み)
-        code_writer = CodeWriter(self.output_file)
-        
+    # 各.vmファイルを変換した結果を、ファイルの順に返す
+    # records=True の場合、各ファイルのコードは命令レコードのリストになる
+    def translateFiles(self, records=False):
+        vm_paths = [os.path.join(self.input_path, f) for f in self.vm_files]
+        # 全体を見る最適化では、先に全ファイルを読み込む
+        programs = None
+        if self.dce or self.inline:
+            programs = [Parser(vm_path).commands() for vm_path in vm_paths]
+        if self.inline:
+            programs = self.inlineFunctions(programs)
+        dead_functions = [frozenset()] * len(vm_paths)
+        if self.dce:
+            dead_functions = self.findDeadFunctions(programs)
+        # インライン展開で書き換えたコマンド列はそのままワーカーに渡す
+        rewritten = programs if self.inline else [None] * len(vm_paths)
+
+        results = [None] * len(vm_paths)
+        cache_files = [None] * len(vm_paths)
+        if self.cache_dir is not None:
+            for i, vm_path in enumerate(vm_paths):
+                if rewritten[i] is not None:
+                    data = repr(rewritten[i]).encode()
+                else:
+                    with open(vm_path, 'rb') as f:
+                        data = f.read()
+                cache_files[i] = _cache_file(self.cache_dir, vm_path, data,
+                                             dict(self.options, optimize=self.optimize,
+                                                  records=records),
+                                             dead_functions[i])
+                results[i] = _load_cache(cache_files[i])
+
+        pending = [i for i, result in enumerate(results) if result is None]
+        pending_paths = [vm_paths[i] for i in pending]
+        pending_dead = [dead_functions[i] for i in pending]
+        pending_commands = [rewritten[i] for i in pending]
+        if self.jobs > 1 and len(pending) > 1:
+            with ProcessPoolExecutor(max_workers=min(self.jobs, len(pending))) as executor:
+                translated = list(executor.map(translate_file, pending_paths,
+                                               [self.options] * len(pending), pending_dead,
+                                               pending_commands, [self.optimize] * len(pending),
+                                               [records] * len(pending)))
+        else:
+            translated = [translate_file(vm_path, self.options, dead, commands, self.optimize,
+                                         records)
+                          for vm_path, dead, commands
+                          in zip(pending_paths, pending_dead, pending_commands)]
+
+        for i, result in zip(pending, translated):
+            results[i] = result
+            if self.cache_dir is not None:
+                _save_cache(cache_files[i], result)
+        if self.cache_dir is not None:
+            print(f"キャッシュ: {len(vm_paths) - len(pending)}件を再利用, {len(pending)}件を変換")
+        return results
+
+    # 小さな葉関数をインライン展開したコマンド列を返す
+    def inlineFunctions(self, programs):
+        programs, report = inline_functions(programs, self.options, self.inline_max,
+                                            self.inline_budget)
+        print(f"インライン展開: {report['sites']}箇所 ({len(report['functions'])}関数), "
+              f"ROM {report['growth']:+d}ワード, "
+              f"各箇所を1回ずつ実行すると推定 {report['saved_cycles']}サイクル削減, "
+              f"呼び出し元の関数の入口で {report['entry_cycles']}サイクル増加")
+        return programs
+
+    # ファイルごとに、到達できない関数の集合を返す
+    def findDeadFunctions(self, programs):
+        reachable = reachable_functions(programs)
+        if reachable is None:
+            print("Sys.initが無いため、未使用関数の削除を行いません")
+            return [frozenset()] * len(programs)
+
+        dead_functions = []
+        for commands in programs:
+            defined = {arg1 for cmd_type, arg1, _ in commands if cmd_type == C_FUNCTION}
+            dead_functions.append(frozenset(defined - reachable))
+        self.dead_function_count = sum(len(dead) for dead in dead_functions)
+        return dead_functions
+
+    # ブートストラップコードの後ろに各ファイルのコード、最後に共有ルーチンを連結する
+    # output_fileがNoneの場合はファイルに書かず、連結したコードを返す
+    # records=True の場合はテキストの代わりに命令レコードのリストを返す
+    def writeProgram(self, output_file, records=False):
+        results = self.translateFiles(records)
+
+        code_writer = CodeWriter(output_file, bootstrap=self.bootstrap, records=records,
+                                 **self.options)
+        dropped_words = 0
+        optimize_totals = [0, 0, 0, 0]
         try:
-            # 各.vmファイルを順番に処理
-            for vm_file in self.vm_files:
-                full_input_path = os.path.join(self.input_path, vm_file)
-                parser = Parser(full_input_path)
-                code_writer.setFileName(full_input_path)
-                
-                try:
-                    while parser.hasMoreLines():
-                        parser.advance()
-                        cmd_type = parser.commandType()
-
-                        if cmd_type is None:
-                            continue
-
-                        if cmd_type == C_ARITHMETIC:
-                            cmd = parser.arg1()
-                            code_writer.WriteArithmetic(cmd)
-                        elif cmd_type in [C_POP, C_PUSH]:
-                            seg = parser.arg1()
-                            index = parser.arg2()
-                            code_writer.WritePushPop(cmd_type, seg, index)
-                        elif cmd_type == C_LABEL:
-                            label = parser.arg1()
-                            code_writer.writeLabel(label)
-                        elif cmd_type == C_GOTO:
-                            label = parser.arg1()
-                            code_writer.writeGoto(label)
-                        elif cmd_type == C_IF:
-                            label = parser.arg1()
-                            code_writer.writeIf(label)
-                        elif cmd_type == C_CALL:
-                            function_name = parser.arg1()
-                            args_num = parser.arg2()
-                            code_writer.writeCall(function_name, int(args_num))
-                        elif cmd_type == C_FUNCTION:
-                            function_name = parser.arg1()
-                            args_num = parser.arg2()
-                            code_writer.writeFunction(function_name, int(args_num))
-                        elif cmd_type == C_RETURN:
-                            code_writer.writeReturn()
-                finally:
-                    parser.close()
+            for vm_file, (code, routines, hits, dropped, stats) in zip(self.vm_files, results):
+                print(f"{os.path.splitext(vm_file)[0]}の変換開始")
+                code_writer.writeFragment(code, routines)
+                for pattern, count in hits.items():
+                    self.fusion_hits[pattern] += count
+                dropped_words += dropped
+                if stats is not None:
+                    optimize_totals = [total + n for total, n in zip(optimize_totals, stats)]
+            if not self.bootstrap:
+                code_writer.writeHalt()
         finally:
             code_writer.close()
 
+        if self.dce:
+            print(f"未使用関数の削除: {self.dead_function_count}関数, {dropped_words}ワード")
+        if self.optimize:
+            vm_before, vm_after, words_before, words_after = optimize_totals
+            print(f"VM最適化: VMコマンド {vm_before} -> {vm_after}, "
+                  f"Hack命令 {words_before} -> {words_after} (各ファイルのコードのみ)")
+
+        if self.fuse:
+            hits = ", ".join(f"{name}={count}" for name, count in self.fusion_hits.items())
+            print(f"融合パターン: {hits}")
+        return code_writer.takeCode()
+
+    def translate(self):
+        self.writeProgram(self.output_file)
+
+    # .asmのテキストを経由せずに機械語まで変換する
+    # CodeWriterが出力した命令レコードをアセンブラの2パスに直接渡す
+    # テキストを作るのは write_asm=True で.asmも書き込む場合だけ
+    def translateToBinary(self, packed=False, write_asm=False):
+        assembler = load_assembler()
+        instructions = self.writeProgram(None, records=True)
+        if write_asm:
+            with open(self.output_file, "w") as f:
+                f.write(records_text(instructions))
+
+        symbol_table = assembler.SymbolTable()
+        assembler.first_pass(instructions, symbol_table)
+        machine_code = assembler.second_pass(instructions, symbol_table, assembler.Code())
+
+        base = os.path.splitext(self.output_file)[0]
+        if packed:
+            binary_file = base + ".hackb"
+            assembler.write_packed(machine_code, binary_file)
+        else:
+            binary_file = base + ".hack"
+            assembler.write_hack(machine_code, binary_file)
+        return binary_file
+
     
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
-        sys.exit(1)
+    arg_parser = argparse.ArgumentParser(description="VMトランスレータ")
+    arg_parser.add_argument("input_path", help=".vmファイルを含むディレクトリ")
+    arg_parser.add_argument("--shared-call", action="store_true",
+                            help="call/returnを共有ルーチンにしてROMを節約する")
+    arg_parser.add_argument("--shared-compare", action="store_true",
+                            help="eq/gt/ltを共有比較ルーチンにしてROMを節約する")
+    arg_parser.add_argument("--cache-tos", action="store_true",
+                            help="スタックの先頭をDレジスタに保持して実行命令数を減らす")
+    arg_parser.add_argument("--fuse", action="store_true",
+                            help="よく現れるコマンド列を1つのコードに融合する")
+    arg_parser.add_argument("--no-bootstrap", action="store_true",
+                            help="ブートストラップを出力せず、最後を停止ループにする(Sys.initの無いテスト用)")
+    arg_parser.add_argument("-j", "--jobs", type=int, default=1,
+                            help="ファイルを並列に変換するプロセス数 (0でCPU数)")
+    arg_parser.add_argument("--cache-dir", nargs="?", const=".vmcache",
+                            help="ファイルごとの変換結果のキャッシュ先 (省略時 .vmcache)")
+    arg_parser.add_argument("--hack", action="store_true",
+                            help=".asmを書かずに機械語(.hack)まで直接変換する")
+    arg_parser.add_argument("--packed", action="store_true",
+                            help="--hack の出力をパック形式(.hackb)にする")
+    arg_parser.add_argument("--keep-asm", action="store_true",
+                            help="--hack の場合も.asmを書き込む")
+    arg_parser.add_argument("--dce", action="store_true",
+                            help="Sys.initから到達できない関数を出力しない")
+    arg_parser.add_argument("-O", "--optimize", action="store_true",
+                            help="VMコマンド列を最適化してから変換する(定数の畳み込みなど)")
+    arg_parser.add_argument("--inline", action="store_true",
+                            help="小さな葉関数の呼び出しを本体で置き換える")
+    arg_parser.add_argument("--inline-max", type=int, default=8,
+                            help="インライン展開する関数の最大コマンド数")
+    arg_parser.add_argument("--inline-budget", type=int, default=512,
+                            help="インライン展開で許すROMの増加(ワード)")
+    args = arg_parser.parse_args()
 
-    input_path = sys.argv[1]
-    
-    translator = VMTranslator(input_path)
-    translator.translate()
+    translator = VMTranslator(args.input_path, shared_call=args.shared_call,
+                              shared_compare=args.shared_compare,
+                              cache_tos=args.cache_tos, fuse=args.fuse,
+                              jobs=args.jobs if args.jobs > 0 else os.cpu_count() or 1,
+                              cache_dir=args.cache_dir, dce=args.dce, inline=args.inline,
+                              inline_max=args.inline_max, inline_budget=args.inline_budget,
+                              optimize=args.optimize, bootstrap=not args.no_bootstrap)
+    if args.hack or args.packed:
+        translator.translateToBinary(packed=args.packed, write_asm=args.keep_asm)
+    else:
+        translator.translate()
 
     print("変換終了")
\ No newline at end of file
@@ -0,0 +1,131 @@
+import contextlib
+import io
+import os
+import shutil
+import sys
+import tempfile
+
+from VMTranslator import VMTranslator
+
+PROJECTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.append(os.path.join(PROJECTS_DIR, "06"))
+import assembler
+import emulator
+
+# 07/08のテストプログラムのディレクトリ(<名前>.tst と <名前>.cmp があるもの)
+def find_programs():
+    programs = []
+    for chapter in ("07", "08"):
+        chapter_dir = os.path.join(PROJECTS_DIR, chapter)
+        for name in sorted(os.listdir(chapter_dir)):
+            program_dir = os.path.join(chapter_dir, name)
+            if os.path.isfile(os.path.join(program_dir, name + ".cmp")):
+                programs.append(program_dir)
+    return programs
+
+# コード生成の組み合わせ。RAMのスタックのままのモードと、スタックの先頭をDに保持するモード
+FLAG_SETS = [
+    {},
+    {"fuse": True},
+    {"shared_call": True},
+    {"shared_compare": True},
+    {"fuse": True, "shared_call": True, "shared_compare": True},
+    {"cache_tos": True},
+    {"cache_tos": True, "fuse": True},
+    {"cache_tos": True, "shared_call": True},
+    {"cache_tos": True, "shared_compare": True},
+    {"cache_tos": True, "fuse": True, "shared_call": True, "shared_compare": True},
+    {"dce": True},
+    {"inline": True},
+    {"optimize": True},
+    {"optimize": True, "fuse": True, "cache_tos": True},
+]
+
+# Sys.initから到達できず、--dceで削除されるはずの関数
+DEAD_FUNCTIONS = {
+    "DeadFunctionTest": {"Main.unused", "Main.helper"},
+}
+
+# --inlineで全ての呼び出しが展開され、callの戻りラベルが無くなるはずのファイル
+INLINED_FILES = {
+    "InlineTest": "Sys",
+}
+
+# 停止ループに達するか、ROMの外へのreturnで終わる(SimpleFunctionは戻りアドレスが1000)
+FINISHED = ("halt", "end")
+
+# プログラムを一時ディレクトリで変換し、アセンブラの最適化なし・ありでアセンブルしてエミュレータで実行する
+# ([最適化なし, ありの (状態, 実行した命令数, ROMのワード数, .cmpとの不一致)], アセンブリのラベルの集合) を返す
+# Sys.vmが無いプログラムはブートストラップなしで変換する
+def run_program(program_dir, flags):
+    name = os.path.basename(program_dir)
+    with tempfile.TemporaryDirectory() as tmp:
+        work_dir = os.path.join(tmp, name)
+        os.mkdir(work_dir)
+        for file_name in os.listdir(program_dir):
+            if file_name.endswith((".vm", ".tst", ".cmp")):
+                shutil.copy(os.path.join(program_dir, file_name), work_dir)
+
+        bootstrap = os.path.exists(os.path.join(work_dir, "Sys.vm"))
+        asm_file = os.path.join(work_dir, name + ".asm")
+        with contextlib.redirect_stdout(io.StringIO()):
+            VMTranslator(work_dir, bootstrap=bootstrap, **flags).translate()
+        with open(asm_file) as f:
+            labels = {line.strip()[1:-1] for line in f if line.startswith("(")}
+
+        runs = []
+        for optimize_code in (False, True):
+            rom_file = os.path.join(work_dir, name + (".opt.hack" if optimize_code else ".hack"))
+            assembler.assemble_file(asm_file, rom_file, optimize_code=optimize_code)
+            with open(rom_file) as f:
+                words = sum(1 for _ in f)
+            status, cycles, mismatches = emulator.run_test(
+                rom_file, os.path.join(work_dir, name + ".tst"),
+                os.path.join(work_dir, name + ".cmp"))
+            runs.append((status, cycles, words, mismatches))
+    return runs, labels
+
+# 到達できない関数が --dce の場合だけ、展開する呼び出しが --inline の場合だけ出力から消えているか
+def labels_ok(program_dir, flags, labels):
+    name = os.path.basename(program_dir)
+    dead = DEAD_FUNCTIONS.get(name)
+    if dead is not None and bool(flags.get("dce")) == bool(dead & labels):
+        return False
+    file_name = INLINED_FILES.get(name)
+    if file_name is not None:
+        has_calls = any(label.startswith(file_name + "$ret.") for label in labels)
+        if bool(flags.get("inline")) == has_calls:
+            return False
+    return True
+
+def test_cmp():
+    failures = []
+    for program_dir in find_programs():
+        for flags in FLAG_SETS:
+            runs, labels = run_program(program_dir, flags)
+            if not labels_ok(program_dir, flags, labels):
+                failures.append((os.path.basename(program_dir), flags, "labels"))
+            for optimize_code, (status, _, _, mismatches) in zip((False, True), runs):
+                if status not in FINISHED or mismatches:
+                    failures.append((os.path.basename(program_dir), flags, optimize_code,
+                                     status, mismatches))
+    assert not failures, failures
+
+if __name__ == "__main__":
+    # -O cycles / -O words は、アセンブラの -O による実行した命令数とROMのワード数の増減(実測)
+    failed = False
+    print(f"{'program':<18} {'flags':<50} {'status':<8} {'cycles':>7} {'words':>6} "
+          f"{'-O cycles':>10} {'-O words':>9}  result")
+    for program_dir in find_programs():
+        for flags in FLAG_SETS:
+            runs, labels = run_program(program_dir, flags)
+            (status, cycles, words, mismatches), (opt_status, opt_cycles, opt_words,
+                                                  opt_mismatches) = runs
+            ok = (status in FINISHED and opt_status in FINISHED and not mismatches
+                  and not opt_mismatches and labels_ok(program_dir, flags, labels))
+            failed |= not ok
+            flag_names = " ".join("--" + flag.replace("_", "-") for flag in flags) or "(default)"
+            print(f"{os.path.basename(program_dir):<18} {flag_names:<50} {status:<8} "
+                  f"{cycles:>7} {words:>6} {opt_cycles - cycles:>+10} {opt_words - words:>+9}  "
+                  f"{'OK' if ok else (mismatches, opt_mismatches)}")
+    sys.exit(1 if failed else 0)